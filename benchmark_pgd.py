@@ -0,0 +1,83 @@
+import torch
+from pgd import Attacker, PGD_DEFAULT_ARGS_DICT
+from model_utils import ARCHS_LIST, get_model
+from device_utils import get_execution_context
+import argparse
+import copy
+import time
+
+
+def get_num_allocations():
+    return torch.cuda.memory_stats()['allocation.all.allocated']
+
+
+# On the CPU the allocations are counted by the profiler, in a separate run so that its overhead is not timed
+def count_cpu_allocations(attack, image_batch, mask_batch, targets):
+    with torch.autograd.profiler.profile(profile_memory=True) as profiler:
+        attack(image_batch, mask_batch, targets)
+    return sum(1 for event in profiler.function_events if event.cpu_memory_usage > 0)
+
+
+def measure(attack, image_batch, mask_batch, targets, num_iterations):
+    if image_batch.is_cuda:
+        torch.cuda.synchronize()
+        num_allocations = get_num_allocations()
+    start = time.perf_counter()
+
+    attack(image_batch, mask_batch, targets)
+
+    if image_batch.is_cuda:
+        torch.cuda.synchronize()
+        elapsed_time = time.perf_counter() - start
+        num_allocations = get_num_allocations() - num_allocations
+    else:
+        elapsed_time = time.perf_counter() - start
+        num_allocations = count_cpu_allocations(attack, image_batch, mask_batch, targets)
+    return elapsed_time / num_iterations, num_allocations / num_iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', type=str, choices=ARCHS_LIST, default='resnet18')
+    parser.add_argument('--norm', type=str, choices=['l2', 'linf'], default='linf')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--image_size', type=int, default=224)
+    parser.add_argument('--num_iterations', type=int, default=20)
+    parser.add_argument('--num_repetitions', type=int, default=5)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args_dict = vars(parser.parse_args())
+
+    pgd_args_dict = copy.copy(PGD_DEFAULT_ARGS_DICT)
+    pgd_args_dict['arch'] = args_dict['arch']
+    pgd_args_dict['norm'] = args_dict['norm']
+    pgd_args_dict['num_iterations'] = args_dict['num_iterations']
+    pgd_args_dict['restart_iterations'] = args_dict['num_iterations'] + 1
+    pgd_args_dict['device'] = args_dict['device']
+    pgd_args_dict['num_threads'] = args_dict['num_threads']
+    context = get_execution_context(pgd_args_dict)
+    context.apply_thread_settings()
+
+    # Timing does not depend on the weights, so the model is not downloaded
+    model = context.prepare_model(get_model(args_dict['arch'], parameters=None, freeze=True)).eval()
+    attacker = Attacker(model, pgd_args_dict)
+
+    image_batch = context.to_device(torch.rand(args_dict['batch_size'], 3, args_dict['image_size'],
+                                               args_dict['image_size']))
+    mask_batch = torch.ones_like(image_batch)
+    targets = context.to_device(torch.randint(0, 1000, [args_dict['batch_size']]))
+
+    for name, attack in [('attack', attacker.attack), ('fast_attack', attacker.fast_attack)]:
+        attack(image_batch, mask_batch, targets)
+
+        measurements = [measure(attack, image_batch, mask_batch, targets, args_dict['num_iterations'])
+                        for _ in range(args_dict['num_repetitions'])]
+        times, allocations = zip(*measurements)
+
+        print('{}: {:.2f} ms and {:.1f} allocations per iteration'.format(name,
+                                                                         1000 * min(times),
+                                                                         min(allocations)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import torch
+from remote_target import AsyncQueryClient
+import argparse
+import asyncio
+import time
+
+
+async def run_queries(client, num_queries, batch_size, image_size, latencies):
+    x_batch = torch.rand(batch_size, 3, image_size, image_size)
+    for _ in range(num_queries):
+        start = time.perf_counter()
+        await client.query(x_batch)
+        latencies.append(time.perf_counter() - start)
+
+
+# Every one of num_clients concurrent clients, e.g. the images of an attack, sends num_queries queries in turn
+async def measure(args_dict, max_batch_size, max_delay):
+    client = AsyncQueryClient(args_dict['address'], args_dict['num_connections'], max_batch_size, max_delay)
+    await client.connect()
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[run_queries(client, args_dict['num_queries'], args_dict['batch_size'],
+                                       args_dict['image_size'], latencies)
+                           for _ in range(args_dict['num_clients'])])
+    elapsed_time = time.perf_counter() - start
+
+    await client.close()
+    return elapsed_time, latencies, client.stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', type=str, default='127.0.0.1:8765')
+    parser.add_argument('--num_clients', type=int, default=32)
+    parser.add_argument('--num_queries', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--image_size', type=int, default=224)
+    parser.add_argument('--num_connections', type=int, default=4)
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_delay', type=float, default=0.002)
+    args_dict = vars(parser.parse_args())
+
+    # Without coalescing every query is sent as a separate request
+    for name, max_batch_size, max_delay in [('separate requests', 1, 0.0),
+                                            ('coalesced requests', args_dict['max_batch_size'],
+                                             args_dict['max_delay'])]:
+        elapsed_time, latencies, stats = asyncio.get_event_loop().run_until_complete(
+            measure(args_dict, max_batch_size, max_delay))
+
+        num_images = args_dict['num_clients'] * args_dict['num_queries'] * args_dict['batch_size']
+        print('{}: {:.1f} images/s, {:.1f} ms mean query latency, {} queries in {} requests'.format(
+            name, num_images / elapsed_time, 1000 * sum(latencies) / len(latencies),
+            stats['queries'], stats['requests']))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,29 +3,73 @@ from torch.nn.functional import softmax
 from model_utils import ARCHS_LIST, predict, get_model
 from pgd import get_current_time, Attacker, PGD_DEFAULT_ARGS_DICT
 from gradient_analysis import get_gradient
+from ensemble_utils import EnsembleExecutor
 from transformations import Blur
 from file_utils import validate_save_file_location
-import random
+from device_utils import ExecutionContext
+from query_utils import QueryOracle, QueryBudgetExceeded, query_oracles
+from remote_target import RemoteTarget
+from dct_utils import dct_2d, get_dct_basis_vectors, get_dct_order
 import argparse
+import copy
+import time
 import sys
 
 
-def get_simba_gradient(model, x, y, criterion, similarity_coeffs):
-    grad = get_gradient(model, x, y, criterion, similarity_coeffs)
+def get_simba_gradient(model, x, y, criterion, similarity_coeffs, ensemble_executor=None):
+    grad = get_gradient(model, x, y, criterion, similarity_coeffs, ensemble_executor)
     return grad
 
 
-def normalize_gradient_vector(grad_vector):
-    grad_normalized = softmax(torch.abs(grad_vector), dim=0)
-    return grad_normalized.tolist()
+# The model is either a QueryOracle or a model which is queried directly
+def query_probabilities(model, x_batch):
+    if isinstance(model, QueryOracle):
+        return model(x_batch)
 
-
-def get_probabilities(model, x, y):
     with torch.no_grad():
-        prediction = predict(model, x.unsqueeze(0))
-        prediction_softmax = softmax(prediction, 1)
-        prediction_softmax_y = prediction_softmax[0][y]
-        return prediction_softmax_y
+        prediction = predict(model, x_batch)
+        return softmax(prediction, 1)
+
+
+# Checks a probability vector which was already queried, so that early stopping needs no extra forward pass
+def is_adversarial(probabilities, y):
+    return torch.argmax(probabilities).item() != y.item()
+
+
+# Per-image statistics of an attack - the queries, the iterations (rounds or NES steps) and the time it used, and
+# the iterations it left unused by stopping early. The queries and the time they would have taken are estimated
+# from the average cost of an iteration. Attacks which ran out of iterations, coordinates or budget free nothing.
+def get_attack_stats(oracle, num_iterations, max_iterations, elapsed_time, successful, stopped_early):
+    stats = oracle.get_stats()
+    freed_iterations = max_iterations - num_iterations if stopped_early else 0
+    freed_queries = round(stats['num_queries'] / max(num_iterations, 1) * freed_iterations)
+    if oracle.query_budget is not None:
+        freed_queries = min(freed_queries, oracle.get_remaining_queries())
+
+    stats['iterations'] = num_iterations
+    stats['stopped_early'] = stopped_early
+    stats['freed_iterations'] = freed_iterations
+    stats['freed_queries'] = freed_queries
+    stats['time'] = elapsed_time
+    stats['estimated_freed_time'] = elapsed_time / max(num_iterations, 1) * freed_iterations
+    stats['successful'] = successful
+    return stats
+
+
+# Order in which the coordinates are tried without gradient priors - random pixels, or DCT coefficients from low to
+# high frequencies
+def get_coordinate_order(x, args_dict):
+    if args_dict['basis'] == 'dct':
+        return get_dct_order(x.size(), args_dict['dct_ordering'], args_dict['dct_frequency_dims'],
+                             args_dict['dct_stride'], x.device)
+    return torch.randperm(x.numel(), device=x.device)
+
+
+# Gradient prior over the coordinates of the basis
+def get_prior_distribution(grad, args_dict):
+    if args_dict['basis'] == 'dct':
+        return torch.flatten(dct_2d(grad))
+    return torch.flatten(grad)
 
 
 def get_tensor_coordinate_indices(coordinate, size):
@@ -35,84 +79,428 @@ def get_tensor_coordinate_indices(coordinate, size):
     return c, w, h
 
 
-def simba(model, x, y, args_dict, substitute_model, criterion, pgd_attacker):
-    delta = torch.zeros_like(x).cuda()
-    q = torch.zeros_like(x).cuda()
-    available_coordinates = None
+# Returns the substitute model(s) of the gradient priors - with ensemble selection, the surrogates chosen for x
+def get_prior_models(x, y, args_dict, substitute_model, pgd_attacker):
     similarity_coeffs = None
-    conv = Blur()
-    conv.parameters = [(9, 3)]
+    ensemble_executor = None
 
     if args_dict['ensemble_selection'] and substitute_model is None:
-        x.unsqueeze_(0)
+        x = x.unsqueeze(0)
         step = pgd_attacker.attack_step(x, 25/255.0, 1/255.0)
         substitute_model = pgd_attacker.selective_transfer(x, torch.ones_like(x), y, step)
         similarity_coeffs = pgd_attacker.similarity_coeffs
-        x.squeeze_()
+        ensemble_executor = pgd_attacker.ensemble_executor
+
+    return substitute_model, similarity_coeffs, ensemble_executor
+
+
+# Sampling distribution over the coordinates of the basis, given by the softmax of the absolute substitute gradient.
+# The gradient is recomputed every prior_refresh_iterations iterations, or once delta has moved further than
+# prior_refresh_distance (in L2) from the delta it was computed at. The coordinates which were already tried have
+# zero weight.
+class GradientPrior:
+    def __init__(self, substitute_model, criterion, similarity_coeffs, ensemble_executor, args_dict, x):
+        self.substitute_model = substitute_model
+        self.criterion = criterion
+        self.similarity_coeffs = similarity_coeffs
+        self.ensemble_executor = ensemble_executor
+        self.args_dict = args_dict
+        self.available_coordinates = torch.ones(x.numel(), device=x.device)
+        self.num_available_coordinates = x.numel()
+        self.grad = None
+        self.weights = None
+        self.refresh_delta = None
+        self.iterations_since_refresh = 0
+
+    def needs_refresh(self, delta):
+        if self.grad is None or self.iterations_since_refresh >= self.args_dict['prior_refresh_iterations']:
+            return True
+
+        refresh_distance = self.args_dict['prior_refresh_distance']
+        return refresh_distance is not None and torch.norm(delta - self.refresh_delta).item() > refresh_distance
+
+    # Returns the substitute gradient at x + delta, which may be stale by up to prior_refresh_iterations iterations
+    def update(self, x, delta, y):
+        if self.needs_refresh(delta):
+            self.grad = get_simba_gradient(self.substitute_model, x + delta, y, self.criterion,
+                                           self.similarity_coeffs, self.ensemble_executor)
+            self.weights = softmax(torch.abs(get_prior_distribution(self.grad, self.args_dict)), dim=0)
+            self.weights *= self.available_coordinates
+            self.refresh_delta = delta.clone()
+            self.iterations_since_refresh = 0
+
+        self.iterations_since_refresh += 1
+        return self.grad
+
+    def sample(self, num_coordinates):
+        return torch.multinomial(self.weights, min(num_coordinates, self.num_available_coordinates))
+
+    # The coordinates have to be distinct and available
+    def remove(self, coordinates):
+        self.available_coordinates[coordinates] = 0
+        self.weights[coordinates] = 0
+        self.num_available_coordinates -= coordinates.numel()
 
-    p = get_probabilities(model, x, y)
 
-    if not args_dict['gradient_priors']:
-        perm = torch.randperm(x.size().numel()).tolist()
-    else:
-        perm = range(0, x.size().numel())
-        available_coordinates = torch.ones(x.size().numel())
+def simba(model, x, y, args_dict, substitute_model, criterion, pgd_attacker):
+    delta = torch.zeros_like(x)
+    q = torch.zeros_like(x)
+    conv = Blur()
+    conv.parameters = [(9, 3)]
 
-    for iteration in range(args_dict['num_iterations']):
-        if args_dict['gradient_priors']:
-            grad = get_simba_gradient(substitute_model, x + delta, y, criterion, similarity_coeffs)
-            distribution = torch.flatten(grad)
-            distribution_normalized = normalize_gradient_vector(distribution*available_coordinates)
-            coordinate = random.choices(perm, distribution_normalized)[0]
-            available_coordinates[coordinate] = 0
+    substitute_model, similarity_coeffs, ensemble_executor = get_prior_models(x, y, args_dict, substitute_model,
+                                                                              pgd_attacker)
 
-            if args_dict['transfer']:
-                delta = delta + args_dict['step_size']*torch.sign(grad.cuda())
-                delta = torch.clamp(delta, -args_dict['eps'], args_dict['eps'])
+    num_iterations = 0
+    stopped_early = False
+    try:
+        probabilities = query_probabilities(model, x.unsqueeze(0))[0]
+        p = probabilities[y]
+        successful = is_adversarial(probabilities, y)
 
+        if not args_dict['gradient_priors']:
+            perm = get_coordinate_order(x, args_dict).tolist()
         else:
-            coordinate = perm[iteration]
+            prior = GradientPrior(substitute_model, criterion, similarity_coeffs, ensemble_executor, args_dict, x)
 
-        c, w, h = get_tensor_coordinate_indices(coordinate, x.size())
+        for iteration in range(args_dict['num_iterations']):
+            if args_dict['early_stopping'] and successful:
+                stopped_early = True
+                break
 
-        q[c, w, h] = 1
+            if args_dict['gradient_priors'] and prior.num_available_coordinates == 0:
+                break
+            num_iterations += 1
 
-        if args_dict['conv']:
-            q = conv(q)[0]
+            if args_dict['gradient_priors']:
+                grad = prior.update(x, delta, y)
+                coordinates = prior.sample(1)
+                prior.remove(coordinates)
+                coordinate = coordinates.item()
 
-        p_prim_left = get_probabilities(model, (x + delta + args_dict['eps'] * q).clamp(0, 1), y)
+                if args_dict['transfer']:
+                    delta = delta + args_dict['step_size']*torch.sign(grad)
+                    delta = torch.clamp(delta, -args_dict['eps'], args_dict['eps'])
 
-        if p_prim_left < p:
-            delta = delta + args_dict['eps'] * q
-            p = p_prim_left
+            else:
+                coordinate = perm[iteration]
 
-        else:
-            p_prim_right = get_probabilities(model, (x + delta - args_dict['eps'] * q).clamp(0, 1), y)
-            if p_prim_right < p:
+            if args_dict['basis'] == 'dct':
+                q = get_coordinate_directions(torch.tensor([coordinate], device=x.device), x, args_dict)[0]
+            else:
+                c, w, h = get_tensor_coordinate_indices(coordinate, x.size())
+
+                q[c, w, h] = 1
+
+                if args_dict['conv']:
+                    q = conv(q)[0]
+
+            left_probabilities = query_probabilities(model,
+                                                     (x + delta + args_dict['eps'] * q).clamp(0, 1).unsqueeze(0))
+            p_prim_left = left_probabilities[0][y]
+
+            if p_prim_left < p:
                 delta = delta + args_dict['eps'] * q
                 p = p_prim_left
+                successful = is_adversarial(left_probabilities[0], y)
+
+            else:
+                right_probabilities = query_probabilities(model,
+                                                          (x + delta - args_dict['eps'] * q).clamp(0, 1).unsqueeze(0))
+                p_prim_right = right_probabilities[0][y]
+                if p_prim_right < p:
+                    delta = delta - args_dict['eps'] * q
+                    p = p_prim_right
+                    successful = is_adversarial(right_probabilities[0], y)
 
-        q.zero_()
+            q.zero_()
+    except QueryBudgetExceeded:
+        pass
+
+    return delta, num_iterations, stopped_early
+
+
+# Unit directions of the given coordinates of the basis, one per row, blurred if args_dict['conv'] is set
+def get_coordinate_directions(coordinates, x, args_dict):
+    if args_dict['basis'] == 'dct':
+        directions = get_dct_basis_vectors(coordinates, x.size(), x.dtype, x.device)
+    else:
+        directions = torch.zeros(coordinates.size(0), x.numel(), device=x.device, dtype=x.dtype)
+        directions[torch.arange(coordinates.size(0), device=x.device), coordinates] = 1
+        directions = directions.view(-1, *x.size())
+
+    if args_dict['conv']:
+        conv = Blur()
+        conv.parameters = [(9, 3)]
+        directions = conv(directions)
+
+    return directions
+
+
+# Acceptance rules of the batched SimBA, for the probabilities of the +eps candidates followed by those of the -eps
+# ones. Returns the new probability, the best sign of every coordinate (0 for +eps and 1 for -eps), and the masks of
+# the accepted coordinates and of those which should be proposed again.
+def select_candidates(probabilities, p, accept_all):
+    candidate_probabilities, signs = probabilities.view(2, -1).min(dim=0)
+    improving = torch.lt(candidate_probabilities, p)
+    retried = torch.zeros_like(improving)
+
+    if accept_all:
+        accepted = improving
+    elif improving.any():
+        accepted = torch.zeros_like(improving)
+        accepted[torch.argmin(candidate_probabilities)] = True
+        p = candidate_probabilities[accepted][0]
+        retried = improving & ~accepted
+    else:
+        accepted = improving
 
-    return delta
+    return p, signs, accepted, retried
 
 
-def nes_gradient(model, x, y, args_dict):
-    sigma = args_dict['eps']
+# Index of the response of the first accepted candidate, among the +eps candidates followed by the -eps ones
+def get_accepted_index(signs, accepted):
+    index = torch.nonzero(accepted)[0, 0]
+    return signs[index] * accepted.size(0) + index
+
+
+# SimBA which proposes simba_batch_size coordinates per round and evaluates the +eps and -eps candidates of all of
+# them with one forward pass, so num_iterations is the number of rounds. With the greedy acceptance rule, the
+# candidate with the lowest probability is accepted if it improves on the current one, and the other improving
+# coordinates are proposed again in the next round, as they were measured against the old delta. With the 'all'
+# rule, every improving coordinate is accepted, and the probability of the combined delta is measured with the
+# candidates of the next round.
+def simba_batched(model, x, y, args_dict, substitute_model, criterion, pgd_attacker):
+    batch_size = args_dict['simba_batch_size']
+    accept_all = args_dict['simba_acceptance'] == 'all'
+    delta = torch.zeros_like(x)
+
+    substitute_model, similarity_coeffs, ensemble_executor = get_prior_models(x, y, args_dict, substitute_model,
+                                                                              pgd_attacker)
+
+    num_iterations = 0
+    stopped_early = False
+    try:
+        probabilities = query_probabilities(model, x.unsqueeze(0))[0]
+        p = probabilities[y]
+        successful = is_adversarial(probabilities, y)
+
+        if args_dict['gradient_priors']:
+            prior = GradientPrior(substitute_model, criterion, similarity_coeffs, ensemble_executor, args_dict, x)
+        else:
+            queue = get_coordinate_order(x, args_dict)
+
+        for iteration in range(args_dict['num_iterations']):
+            if args_dict['early_stopping'] and successful:
+                stopped_early = True
+                break
+
+            if args_dict['gradient_priors']:
+                if prior.num_available_coordinates == 0:
+                    break
+                grad = prior.update(x, delta, y)
+                coordinates = prior.sample(batch_size)
+
+                if args_dict['transfer']:
+                    delta = delta + args_dict['step_size']*torch.sign(grad)
+                    delta = torch.clamp(delta, -args_dict['eps'], args_dict['eps'])
+            else:
+                if queue.size(0) == 0:
+                    break
+                coordinates, queue = queue[:batch_size], queue[batch_size:]
+            num_iterations += 1
+
+            directions = args_dict['eps'] * get_coordinate_directions(coordinates, x, args_dict)
+            candidates = torch.cat([x + delta + directions, x + delta - directions]).clamp(0, 1)
+            if accept_all:
+                candidates = torch.cat([(x + delta).clamp(0, 1).unsqueeze(0), candidates])
+
+            responses = query_probabilities(model, candidates)
+            if accept_all:
+                # The combined delta of the previous round is only measured now
+                p = responses[0][y]
+                successful = is_adversarial(responses[0], y)
+                responses = responses[1:]
+                if args_dict['early_stopping'] and successful:
+                    stopped_early = True
+                    break
+
+            p, signs, accepted, retried = select_candidates(responses[:, y].view(-1), p, accept_all)
+            directions_signs = (1 - 2 * signs[accepted]).to(x.dtype).view(-1, 1, 1, 1)
+            delta = delta + (directions_signs * directions[accepted]).sum(dim=0)
+
+            if not accept_all and accepted.any():
+                successful = is_adversarial(responses[get_accepted_index(signs, accepted)], y)
+
+            if args_dict['gradient_priors']:
+                prior.remove(coordinates[~retried])
+            else:
+                queue = torch.cat([coordinates[retried], queue])
+    except QueryBudgetExceeded:
+        pass
+
+    return delta, num_iterations, stopped_early
+
+
+# State of an image attacked by the image pool, with the rules of simba_batched. The first round also queries the
+# image itself, to get its initial probability.
+class SimbaState:
+    def __init__(self, index, image, label, original_prediction, oracle, args_dict):
+        self.index = index
+        self.image = image
+        self.label = label
+        self.original_prediction = original_prediction
+        self.oracle = oracle
+        self.args_dict = args_dict
+        self.accept_all = args_dict['simba_acceptance'] == 'all'
+        self.delta = torch.zeros_like(image)
+        self.p = None
+        self.queue = get_coordinate_order(image, args_dict)
+        self.iteration = 0
+        self.successful = False
+        self.start_time = time.perf_counter()
+        self.coordinates = None
+        self.directions = None
+
+    def get_num_candidates(self):
+        num_candidates = 2 * min(self.args_dict['simba_batch_size'], self.queue.size(0))
+        return num_candidates + (1 if self.p is None or self.accept_all else 0)
+
+    def is_finished(self):
+        remaining_queries = self.oracle.get_remaining_queries()
+        return (self.iteration == self.args_dict['num_iterations'] or self.queue.size(0) == 0 or
+                (self.args_dict['early_stopping'] and self.successful) or
+                (remaining_queries is not None and remaining_queries < self.get_num_candidates()))
+
+    def get_candidates(self):
+        batch_size = self.args_dict['simba_batch_size']
+        self.coordinates, self.queue = self.queue[:batch_size], self.queue[batch_size:]
+        self.directions = self.args_dict['eps'] * get_coordinate_directions(self.coordinates, self.image,
+                                                                            self.args_dict)
+
+        x = self.image + self.delta
+        candidates = torch.cat([x + self.directions, x - self.directions]).clamp(0, 1)
+        if self.p is None or self.accept_all:
+            candidates = torch.cat([x.clamp(0, 1).unsqueeze(0), candidates])
+        return candidates
+
+    def update(self, responses):
+        self.iteration += 1
+        if self.p is None or self.accept_all:
+            self.p = responses[0][self.label]
+            self.successful = is_adversarial(responses[0], self.label)
+            responses = responses[1:]
+            if self.args_dict['early_stopping'] and self.successful:
+                return
+
+        self.p, signs, accepted, retried = select_candidates(responses[:, self.label].view(-1), self.p,
+                                                             self.accept_all)
+        directions_signs = (1 - 2 * signs[accepted]).to(self.image.dtype).view(-1, 1, 1, 1)
+        self.delta = self.delta + (directions_signs * self.directions[accepted]).sum(dim=0)
+        self.queue = torch.cat([self.coordinates[retried], self.queue])
+
+        if not self.accept_all and accepted.any():
+            self.successful = is_adversarial(responses[get_accepted_index(signs, accepted)], self.label)
+
+
+# Attacks the images of the dataset with SimBA, keeping pool_size of them in flight. Every image has its own
+# coordinate order, delta, probability and query oracle, and every round the candidates of all images are evaluated
+# with a single forward pass of the target. Finished images are replaced by new ones from the dataset. The images
+# have to be of the same size. Returns the results in the order of the dataset.
+def run_simba_pool(model, target, dataset, context, args_dict):
+    images = iter(enumerate(dataset))
+    dataset_exhausted = False
+    active_states = []
+    results = {}
+
+    while True:
+        new_images = []
+        while not dataset_exhausted and len(active_states) + len(new_images) < args_dict['pool_size']:
+            item = next(images, None)
+            if item is None:
+                dataset_exhausted = True
+                break
+            new_images.append((item[0], context.to_device(item[1])))
+
+        if len(new_images) > 0:
+            with torch.no_grad():
+                original_predictions = predict(model, torch.stack([image for _, image in new_images]))
+            for (index, image), original_prediction in zip(new_images, original_predictions):
+                label = torch.argmax(original_prediction).view(1)
+                oracle = QueryOracle(target, args_dict['query_budget'], args_dict['query_cache_size'])
+                active_states.append(SimbaState(index, image, label, original_prediction.unsqueeze(0), oracle,
+                                                args_dict))
+
+        finished = [state.is_finished() for state in active_states]
+        finished_states = [state for state, is_finished in zip(active_states, finished) if is_finished]
+        active_states = [state for state, is_finished in zip(active_states, finished) if not is_finished]
+
+        if len(finished_states) > 0:
+            adversarial_examples = torch.stack([(state.image + state.delta).clamp(0, 1) for state in finished_states])
+            with torch.no_grad():
+                adversarial_predictions = predict(model, adversarial_examples)
+            for state, adversarial_example, adversarial_prediction in zip(finished_states, adversarial_examples,
+                                                                          adversarial_predictions):
+                successful = is_adversarial(adversarial_prediction, state.label)
+                stopped_early = args_dict['early_stopping'] and state.successful
+                results[state.index] = (adversarial_example.cpu(),
+                                        {'original': state.original_prediction.cpu(),
+                                         'adversarial': adversarial_prediction.unsqueeze(0).cpu()},
+                                        get_attack_stats(state.oracle, state.iteration, args_dict['num_iterations'],
+                                                         time.perf_counter() - state.start_time, successful,
+                                                         stopped_early))
+
+        # The pool is refilled at the start of the next round, so it only ends once the dataset is exhausted
+        if len(active_states) == 0:
+            if dataset_exhausted:
+                break
+            continue
+
+        responses = query_oracles([state.oracle for state in active_states],
+                                  [state.get_candidates() for state in active_states])
+        for state, response in zip(active_states, responses):
+            state.update(response)
+
+    return [list(values) for values in zip(*[results[index] for index in sorted(results)])]
+
+
+# Antithetic NES estimate of the gradient of the probability of label y, from num_iterations pairs of samples. The
+# 2 * nes_batch_size images of a chunk of pairs are evaluated with one forward pass and the estimate is accumulated
+# as a running sum, so the memory does not grow with the number of samples. With include_current, x is sent along
+# with the first chunk and its probabilities are returned too, so that checking it for success costs one image and
+# no extra forward pass.
+def nes_gradient(model, x, y, args_dict, include_current=False):
+    sigma = args_dict['nes_sigma'] or args_dict['eps']
     n = args_dict['num_iterations']
-    x_shape = x.size()
-    g = torch.zeros(x_shape).cuda()
-    mean = torch.zeros(x_shape).cuda()
-    std = torch.ones(x_shape).cuda()
+    g = torch.zeros_like(x)
+    current_probabilities = None
+
+    # With a query budget, the estimate uses the antithetic pairs which fit in it
+    num_samples = 0
+    try:
+        while num_samples < n:
+            include_x = include_current and current_probabilities is None
+            chunk_size = min(args_dict['nes_batch_size'], n - num_samples)
+            if isinstance(model, QueryOracle) and model.query_budget is not None:
+                chunk_size = min(chunk_size, (model.get_remaining_queries() - int(include_x)) // 2)
+                if chunk_size <= 0:
+                    break
+
+            u = torch.randn(chunk_size, *x.size(), device=x.device, dtype=x.dtype)
+            candidates = torch.cat([x + sigma*u, x - sigma*u]).clamp(0, 1)
+            if include_x:
+                responses = query_probabilities(model, torch.cat([x.unsqueeze(0), candidates]))
+                current_probabilities, responses = responses[0], responses[1:]
+            else:
+                responses = query_probabilities(model, candidates)
+            pred_plus, pred_minus = responses[:, y].view(2, chunk_size)
 
-    for i in range(n):
-        u = torch.normal(mean, std).cuda()
-        pred = get_probabilities(model, (x+sigma*u).clamp(0, 1), y)
-        g = g + pred*u
-        pred = get_probabilities(model, (x-sigma*u).clamp(0, 1), y)
-        g = g - pred*u
+            g += ((pred_plus - pred_minus).view(-1, 1, 1, 1)*u).sum(dim=0)
+            num_samples += chunk_size
+    except QueryBudgetExceeded:
+        pass
 
-    return g/(2*n*sigma)
+    return g/(2*max(num_samples, 1)*sigma), current_probabilities
 
 
 def fgsm_grad(image, grad, eps):
@@ -120,70 +508,163 @@ def fgsm_grad(image, grad, eps):
     return adversarial_example.detach()
 
 
+# NES-PGD - every step descends the estimated gradient of the probability of the label and projects back to the eps
+# ball. A single step is the original NES attack, with a step of size eps. With early stopping, the attack stops at
+# the first iterate which is misclassified.
 def nes(model, image, label, args_dict, *args):
-    return fgsm_grad(image, nes_gradient(model, image, label, args_dict), args_dict['eps'])-image
+    step_size = args_dict['eps'] if args_dict['nes_steps'] == 1 else args_dict['step_size']
+    x = image
+    num_steps = 0
+    stopped_early = False
+
+    for step in range(args_dict['nes_steps']):
+        if isinstance(model, QueryOracle) and model.query_budget is not None and model.get_remaining_queries() < 2:
+            break
+
+        g, current_probabilities = nes_gradient(model, x, label, args_dict,
+                                                include_current=args_dict['early_stopping'])
+        if current_probabilities is not None and is_adversarial(current_probabilities, label):
+            stopped_early = True
+            break
+
+        x = fgsm_grad(x, -g, step_size)
+        x = torch.min(torch.max(x, image - args_dict['eps']), image + args_dict['eps']).clamp(0, 1)
+        num_steps += 1
+
+    return x-image, num_steps, stopped_early
+
+
+def run_sequential(model, target, dataset, context, attack, args_dict, substitute_model, pgd_attacker):
+    oracle = QueryOracle(target, args_dict['query_budget'], args_dict['query_cache_size'])
+
+    adversarial_examples_list = []
+    predictions_list = []
+    queries_list = []
+
+    for index, image in enumerate(dataset):
+        image = context.to_device(image)
+        with torch.no_grad():
+            original_prediction = predict(model, image.unsqueeze(0))
+        label = torch.argmax(original_prediction, dim=1)
+
+        criterion = torch.nn.CrossEntropyLoss(reduction='none')
+
+        oracle.reset()
+        start_time = time.perf_counter()
+        delta, num_iterations, stopped_early = attack(oracle, image, label, args_dict, substitute_model, criterion,
+                                                      pgd_attacker)
+        elapsed_time = time.perf_counter() - start_time
+        adversarial_example = (image + delta).clamp(0, 1)
+
+        with torch.no_grad():
+            adversarial_prediction = predict(model, adversarial_example.unsqueeze(0))
+
+        max_iterations = args_dict['nes_steps'] if attack is nes else args_dict['num_iterations']
+        successful = is_adversarial(adversarial_prediction[0], label)
+
+        adversarial_examples_list.append(adversarial_example.cpu())
+        predictions_list.append({'original': original_prediction.cpu(),
+                                 'adversarial': adversarial_prediction.cpu()})
+        queries_list.append(get_attack_stats(oracle, num_iterations, max_iterations, elapsed_time, successful,
+                                             stopped_early))
+
+    return adversarial_examples_list, predictions_list, queries_list
 
 
 def main():
-    time = get_current_time()
+    current_time = get_current_time()
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--model', type=str, choices=ARCHS_LIST, default='resnet50')
     parser.add_argument('--dataset', type=str, default='dataset/imagenet-airplanes-images.pt')
+    parser.add_argument('--cache_dataset', default=False, action='store_true')
     parser.add_argument('--gradient_priors', default=False, action='store_true')
+    parser.add_argument('--prior_refresh_iterations', type=int, default=1)
+    parser.add_argument('--prior_refresh_distance', type=float, default=None)
     parser.add_argument('--attack_type', type=str, choices=['nes', 'simba'], default='simba')
     parser.add_argument('--conv', default=False, action='store_true')
+    parser.add_argument('--basis', type=str, choices=['pixel', 'dct'], default='pixel')
+    parser.add_argument('--dct_ordering', type=str, choices=['block', 'diagonal'], default='block')
+    parser.add_argument('--dct_frequency_dims', type=int, default=28)
+    parser.add_argument('--dct_stride', type=int, default=7)
+    parser.add_argument('--simba_batch_size', type=int, default=1)
+    parser.add_argument('--simba_acceptance', type=str, choices=['greedy', 'all'], default='greedy')
+    parser.add_argument('--pool_size', type=int, default=1)
+    parser.add_argument('--early_stopping', default=False, action='store_true')
     parser.add_argument('--substitute_model', type=str, choices=ARCHS_LIST, default='resnet152')
     parser.add_argument('--ensemble_selection', default=False, action='store_true')
+    parser.add_argument('--ensemble_workers', type=int, default=0)
     parser.add_argument('--transfer', default=False, action='store_true')
     parser.add_argument('--eps', type=float, default=10)
     parser.add_argument('--step_size', type=float, default=1/255.0)
     parser.add_argument('--num_iterations', type=int, default=1)
-    parser.add_argument('--save_file_location', type=str, default='results/blackbox/' + time + '.pt')
+    parser.add_argument('--nes_batch_size', type=int, default=50)
+    parser.add_argument('--nes_steps', type=int, default=1)
+    parser.add_argument('--nes_sigma', type=float, default=None)
+    parser.add_argument('--query_budget', type=int, default=None)
+    parser.add_argument('--query_cache_size', type=int, default=1024)
+    parser.add_argument('--target_address', type=str, default=None)
+    parser.add_argument('--target_connections', type=int, default=4)
+    parser.add_argument('--target_max_batch_size', type=int, default=256)
+    parser.add_argument('--target_max_delay', type=float, default=0.002)
+    parser.add_argument('--target_timeout', type=float, default=60.0)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--save_file_location', type=str, default='results/blackbox/' + current_time + '.pt')
     args_dict = vars(parser.parse_args())
 
     validate_save_file_location(args_dict['save_file_location'])
 
-    model = get_model(args_dict['model'], parameters='standard').cuda().eval()
+    context = ExecutionContext(device=args_dict['device'], num_threads=args_dict['num_threads'])
+    context.apply_thread_settings()
+    model = context.prepare_model(get_model(args_dict['model'], parameters='standard')).eval()
 
     dataset = torch.load(args_dict['dataset'])
+    if args_dict['cache_dataset']:
+        dataset.enable_cache()
 
-    adversarial_examples_list = []
-    predictions_list = []
     substitute_model, criterion, pgd_attacker = None, None, None
 
     if args_dict['attack_type'] == 'nes':
         attack = nes
     else:
-        attack = simba
+        attack = simba_batched if args_dict['simba_batch_size'] > 1 else simba
         if args_dict['gradient_priors']:
             if args_dict['ensemble_selection']:
-                pgd_attacker = Attacker(model.cuda(), PGD_DEFAULT_ARGS_DICT)
+                pgd_args_dict = copy.copy(PGD_DEFAULT_ARGS_DICT)
+                pgd_args_dict['device'] = args_dict['device']
+                pgd_args_dict['num_threads'] = args_dict['num_threads']
+                pgd_attacker = Attacker(model, pgd_args_dict)
                 pgd_attacker.args_dict['label_shifts'] = 0
                 pgd_attacker.available_surrogates_list = ARCHS_LIST
                 pgd_attacker.available_surrogates_list.remove(args_dict['model'])
+                if args_dict['ensemble_workers'] > 0:
+                    pgd_attacker.ensemble_executor = EnsembleExecutor(args_dict['ensemble_workers'])
             else:
-                substitute_model = get_model(args_dict['substitute_model'], parameters='standard').cuda().eval()
-
-    for index, image in enumerate(dataset):
-        with torch.no_grad():
-            original_prediction = predict(model, image.cuda().unsqueeze(0))
-        label = torch.argmax(original_prediction, dim=1)
-
-        criterion = torch.nn.CrossEntropyLoss(reduction='none')
-
-        delta = attack(model, image.cuda(), label.cuda(), args_dict, substitute_model, criterion, pgd_attacker)
-        adversarial_example = (image.cuda() + delta).clamp(0, 1)
-
-        with torch.no_grad():
-            adversarial_prediction = predict(model, adversarial_example.unsqueeze(0))
-
-        adversarial_examples_list.append(adversarial_example.cpu())
-        predictions_list.append({'original': original_prediction.cpu(),
-                                 'adversarial': adversarial_prediction.cpu()})
+                substitute_model = get_model(args_dict['substitute_model'], parameters='standard')
+                substitute_model = context.prepare_model(substitute_model).eval()
+
+    # The queries go to a served model if a target address is set, the local model is only used for the clean and
+    # final predictions
+    target = model
+    if args_dict['target_address'] is not None:
+        target = RemoteTarget(args_dict['target_address'],
+                              args_dict['target_connections'],
+                              args_dict['target_max_batch_size'],
+                              args_dict['target_max_delay'],
+                              args_dict['target_timeout'])
+
+    if args_dict['pool_size'] > 1:
+        if args_dict['attack_type'] != 'simba' or args_dict['gradient_priors']:
+            sys.exit('The image pool only supports SimBA without gradient priors!')
+        results = run_simba_pool(model, target, dataset, context, args_dict)
+    else:
+        results = run_sequential(model, target, dataset, context, attack, args_dict, substitute_model, pgd_attacker)
+    adversarial_examples_list, predictions_list, queries_list = results
 
     torch.save({'adversarial_examples': adversarial_examples_list,
                 'predictions': predictions_list,
+                'queries': queries_list,
                 'args_dict': args_dict},
                args_dict['save_file_location'])
 
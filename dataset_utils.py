@@ -9,7 +9,9 @@ from torchvision.utils import save_image
 import datasets
 from model_utils import get_model
 import os
+import random
 from abc import ABC
+from collections import defaultdict
 import shutil
 import json
 import ast
@@ -39,6 +41,68 @@ def create_data_loaders(images, labels, batch_size=10, num_workers=4, shuffle=Tr
     return images_loader, labels_loader
 
 
+def get_image_sizes(dataset):
+    if hasattr(dataset, 'get_image_size'):
+        return [dataset.get_image_size(index) for index in range(len(dataset))]
+    return [tuple(dataset[index][0].size()[1:]) for index in range(len(dataset))]
+
+
+# Groups the dataset indices into buckets of images whose sizes, rounded up to a multiple of granularity, are equal
+# and yields batches from within a single bucket. With num_shards > 1 only every num_shards-th batch is yielded.
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, sizes, batch_size, granularity=1, shuffle=False, num_shards=1, shard_index=0, start_batch=0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.start_batch = start_batch
+        self.buckets = defaultdict(list)
+
+        for index, (height, width) in enumerate(sizes):
+            bucket_size = (-(-height // granularity) * granularity, -(-width // granularity) * granularity)
+            self.buckets[bucket_size].append(index)
+
+    def get_batches(self):
+        batches = []
+        for indices in self.buckets.values():
+            batches.extend([indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)])
+        # The batches before start_batch, e.g. those done before a run was resumed, are never loaded
+        return batches[self.shard_index::self.num_shards][self.start_batch:]
+
+    def __iter__(self):
+        batches = self.get_batches()
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
+# Pads the images and the masks of a batch to the largest size in it - the padded area has a zero mask, so it is
+# never perturbed
+def pad_collate(batch):
+    height = max(image.size(1) for image, _ in batch)
+    width = max(image.size(2) for image, _ in batch)
+
+    image_batch = torch.zeros(len(batch), batch[0][0].size(0), height, width)
+    mask_batch = torch.zeros(len(batch), batch[0][1].size(0), height, width)
+
+    for index, (image, mask) in enumerate(batch):
+        image_batch[index, :, :image.size(1), :image.size(2)] = image
+        mask_batch[index, :, :mask.size(1), :mask.size(2)] = mask
+
+    return image_batch, mask_batch
+
+
+def create_bucketed_loader(dataset, batch_size, num_workers=4, granularity=1, shuffle=False,
+                           num_shards=1, shard_index=0, start_batch=0):
+    sampler = BucketBatchSampler(get_image_sizes(dataset), batch_size, granularity, shuffle,
+                                 num_shards, shard_index, start_batch)
+    return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers,
+                                       collate_fn=pad_collate)
+
+
 def plot_image(image):
     if image.size(0) == 3:
         plt.imshow(image.cpu().permute(1, 2, 0))
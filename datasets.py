@@ -1,8 +1,131 @@
 import os
+import json
+import numpy as np
 from PIL import Image
+from torchvision.transforms import transforms
 import torch
 
 
+# The transforms which follow ToTensor, which are run every time a cached image is loaded. Only the decoded images
+# are exact in 8 bits - e.g. a resize of the float tensor is not - so any other transform cannot be cached.
+def get_cached_transform(transform):
+    if isinstance(transform, transforms.ToTensor):
+        return transforms.Compose([])
+    if (isinstance(transform, transforms.Compose) and len(transform.transforms) > 0 and
+            isinstance(transform.transforms[0], transforms.ToTensor)):
+        return transforms.Compose(transform.transforms[1:])
+    raise ValueError('The decoded cache only supports transforms which start with ToTensor!')
+
+
+# On-disk cache of decoded images - every image is stored as uint8 CHW in a single memory-mapped file, together
+# with an index of offsets and shapes, so loading an image is a view into the file followed by a conversion to
+# float, which is exactly what ToTensor returns. The rest of the transform is run on load, so cached and uncached
+# images are identical. Masks are stored as one bit-packed channel, so they have to be binary.
+class DecodedCache:
+    def __init__(self, location, transform):
+        self.location = location
+        self.transform = transform
+        self.index = None
+        self.images = None
+        self.masks = None
+
+    def get_key(self, names):
+        return {'names': list(names), 'format': 'decoded'}
+
+    def is_valid(self, names):
+        index_location = os.path.join(self.location, 'index.json')
+        if not os.path.exists(index_location):
+            return False
+
+        with open(index_location) as file:
+            index = json.load(file)
+        return index['key'] == self.get_key(names)
+
+    # The files are written to temporary files first and moved into place, and the index is removed before and
+    # written last, so an interrupted or concurrent build never leaves a cache which is_valid accepts but which does
+    # not match its index
+    def build(self, names, decode):
+        if not os.path.exists(self.location):
+            os.makedirs(self.location)
+
+        index_location = os.path.join(self.location, 'index.json')
+        if os.path.exists(index_location):
+            os.remove(index_location)
+
+        index = {'key': self.get_key(names), 'images': [], 'masks': []}
+        images_offset, masks_offset = 0, 0
+        suffix = '.tmp' + str(os.getpid())
+
+        with open(os.path.join(self.location, 'images.u8' + suffix), 'wb') as images_file, \
+                open(os.path.join(self.location, 'masks.u8' + suffix), 'wb') as masks_file:
+            for item_index in range(len(names)):
+                item = decode(item_index)
+                image, mask = item if type(item) == list else (item, None)
+
+                image = np.ascontiguousarray(np.asarray(image, dtype=np.uint8).transpose(2, 0, 1))
+                images_file.write(image.tobytes())
+                index['images'].append([images_offset, *image.shape])
+                images_offset += image.size
+
+                if mask is not None:
+                    mask = np.asarray(mask, dtype=np.uint8)
+                    packed_mask = np.packbits(mask[:, :, 0] >= 128)
+                    masks_file.write(packed_mask.tobytes())
+                    index['masks'].append([masks_offset, mask.shape[2], *mask.shape[:2]])
+                    masks_offset += packed_mask.size
+
+        for name in ['images.u8', 'masks.u8']:
+            os.replace(os.path.join(self.location, name + suffix), os.path.join(self.location, name))
+        with open(index_location + suffix, 'w') as file:
+            json.dump(index, file)
+        os.replace(index_location + suffix, index_location)
+
+    def open(self):
+        with open(os.path.join(self.location, 'index.json')) as file:
+            self.index = json.load(file)
+        self.images = np.memmap(os.path.join(self.location, 'images.u8'), dtype=np.uint8, mode='c')
+        if len(self.index['masks']) > 0:
+            self.masks = np.memmap(os.path.join(self.location, 'masks.u8'), dtype=np.uint8, mode='c')
+
+    def get_image(self, index):
+        offset, channels, height, width = self.index['images'][index]
+        image = self.images[offset:offset + channels * height * width].reshape(channels, height, width)
+        return torch.from_numpy(image).float().div_(255)
+
+    def get_mask(self, index):
+        offset, channels, height, width = self.index['masks'][index]
+        packed_mask = self.masks[offset:offset + (height * width + 7) // 8]
+        mask = np.unpackbits(packed_mask, count=height * width).reshape(1, height, width)
+        return torch.from_numpy(mask).float().expand(channels, height, width)
+
+    def get_image_size(self, index):
+        if self.index is None:
+            self.open()
+        _, _, height, width = self.index['images'][index]
+        return height, width
+
+    def __getitem__(self, index):
+        if self.index is None:
+            self.open()
+
+        if self.masks is None:
+            return self.transform(self.get_image(index))
+        return [self.transform(self.get_image(index)), self.transform(self.get_mask(index))]
+
+    # The memory maps are reopened lazily, so they are not copied into DataLoader workers
+    def __getstate__(self):
+        return {'location': self.location, 'transform': self.transform, 'index': None, 'images': None,
+                'masks': None}
+
+
+def enable_decoded_cache(dataset, names, cache_location):
+    cache = DecodedCache(cache_location, get_cached_transform(dataset.transform))
+    if not cache.is_valid(names):
+        print('Building decoded dataset cache in ' + cache_location + '...')
+        cache.build(names, dataset.decode)
+    dataset.cache = cache
+
+
 # Class for a custom dataset - ImageNet
 class ImageNet(torch.utils.data.Dataset):
     def __init__(self, location, transform):
@@ -14,11 +137,21 @@ class ImageNet(torch.utils.data.Dataset):
         return len(self.all_images)
 
     def __getitem__(self, index):
-        image_location = os.path.join(self.location, self.all_images[index])
-        image = Image.open(image_location).convert("RGB")
-        tensor_image = self.transform(image)
+        if getattr(self, 'cache', None) is not None:
+            return self.cache[index]
+
+        tensor_image = self.transform(self.decode(index))
         return tensor_image
 
+    def decode(self, index):
+        image_location = os.path.join(self.location, self.all_images[index])
+        return Image.open(image_location).convert("RGB")
+
+    def enable_cache(self, cache_location=None):
+        if cache_location is None:
+            cache_location = self.location.rstrip('/') + '_cache'
+        enable_decoded_cache(self, self.all_images, cache_location)
+
 
 # Class for a custom dataset for given COCO category
 class CocoCategory(torch.utils.data.Dataset):
@@ -38,13 +171,34 @@ class CocoCategory(torch.utils.data.Dataset):
         return len(self.images)
 
     def __getitem__(self, index):
+        if getattr(self, 'cache', None) is not None:
+            return self.cache[index]
+
+        image, mask = self.decode(index)
+        return [self.transform(image), self.transform(mask)]
+
+    def decode(self, index):
         image_location = os.path.join(os.path.join(self.location, 'images'), self.images[index])
         mask_location = os.path.join(os.path.join(self.location, 'masks'), self.images[index])
 
         image = Image.open(image_location).convert("RGB")
         mask = Image.open(mask_location).convert("RGB")
+        return [image, mask]
 
-        return [self.transform(image), self.transform(mask)]
+    # Reads only the image header, so the size is known without decoding the image
+    def get_image_size(self, index):
+        if getattr(self, 'cache', None) is not None:
+            return self.cache.get_image_size(index)
+
+        image_location = os.path.join(os.path.join(self.location, 'images'), self.images[index])
+        with Image.open(image_location) as image:
+            width, height = image.size
+        return height, width
 
     def get_category(self):
         return self.category
+
+    def enable_cache(self, cache_location=None):
+        if cache_location is None:
+            cache_location = self.location.rstrip('/') + '_cache'
+        enable_decoded_cache(self, self.images, cache_location)
@@ -0,0 +1,56 @@
+import torch
+import functools
+import math
+
+
+# Orthonormal DCT-II matrix - row k is the k-th cosine basis vector, so the inverse DCT of the k-th unit
+# coefficient vector is the k-th row
+@functools.lru_cache(maxsize=16)
+def get_dct_matrix(size, dtype, device):
+    n = torch.arange(size, dtype=torch.float64)
+    k = n.unsqueeze(1)
+    matrix = torch.cos(math.pi * (2 * n + 1) * k / (2 * size)) * math.sqrt(2.0 / size)
+    matrix[0] /= math.sqrt(2.0)
+    return matrix.to(dtype=dtype, device=device)
+
+
+# 2D DCT of every channel of x
+def dct_2d(x):
+    dct_height = get_dct_matrix(x.size(-2), x.dtype, x.device)
+    dct_width = get_dct_matrix(x.size(-1), x.dtype, x.device)
+    return dct_height @ x @ dct_width.t()
+
+
+# Images of the DCT basis vectors of the given coefficients, indexed like a flattened CxHxW tensor. Every basis
+# vector is the outer product of two rows of the DCT matrices, so only those are kept in memory.
+def get_dct_basis_vectors(coordinates, size, dtype, device):
+    channels, height, width = size[-3:]
+    c, coordinates = coordinates // (height * width), coordinates % (height * width)
+    u, v = coordinates // width, coordinates % width
+
+    rows = get_dct_matrix(height, dtype, device)[u]
+    columns = get_dct_matrix(width, dtype, device)[v]
+
+    basis_vectors = torch.zeros(coordinates.size(0), channels, height, width, dtype=dtype, device=device)
+    basis_vectors[torch.arange(coordinates.size(0), device=device), c] = rows.unsqueeze(2) * columns.unsqueeze(1)
+    return basis_vectors
+
+
+# Coefficients ordered from low to high frequencies. With the block ordering, the first frequency_dims x
+# frequency_dims block comes first, followed by bands of stride frequencies which extend the block in both
+# directions, and with the diagonal ordering the coefficients are ordered by u + v. The order within a band or a
+# diagonal is random.
+def get_dct_order(size, ordering='block', frequency_dims=28, stride=7, device=None):
+    channels, height, width = size[-3:]
+    u = torch.arange(height, device=device).view(1, -1, 1).expand(channels, height, width)
+    v = torch.arange(width, device=device).view(1, 1, -1).expand(channels, height, width)
+
+    if ordering == 'block':
+        bands = torch.clamp((torch.max(u, v) - frequency_dims) // stride + 1, min=0)
+    elif ordering == 'diagonal':
+        bands = u + v
+    else:
+        raise ValueError('Invalid DCT ordering!')
+
+    keys = bands.float() + torch.rand(bands.size(), device=device)
+    return torch.argsort(keys.flatten())
@@ -0,0 +1,52 @@
+import torch
+import os
+
+
+def get_default_device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+# Respects the CPU affinity of the process, e.g. when it is limited by taskset or a container
+def get_num_available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+# Device, dtype and CPU threading settings shared by the attacks, the attack steps and the transformations. On the
+# CPU the defaults use every core for intra-op parallelism and the channels_last memory format, which the mkldnn
+# convolutions are fastest with. The thread count is process-wide, so it is only set by apply_thread_settings, which
+# the scripts call once at startup - contexts are also built by every Attacker.
+class ExecutionContext:
+    def __init__(self, device=None, dtype=torch.float, num_threads=None, channels_last=None):
+        self.device = torch.device(device) if device is not None else get_default_device()
+        self.dtype = dtype
+        self.channels_last = self.device.type == 'cpu' if channels_last is None else channels_last
+
+        if num_threads is None and self.device.type == 'cpu':
+            num_threads = get_num_available_cores()
+        self.num_threads = num_threads
+
+    def apply_thread_settings(self):
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+    def to_device(self, x):
+        if x.is_floating_point():
+            x = x.to(device=self.device, dtype=self.dtype)
+        else:
+            x = x.to(device=self.device)
+
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def prepare_model(self, model):
+        model = model.to(device=self.device, dtype=self.dtype)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        return model
+
+
+def get_execution_context(args_dict):
+    return ExecutionContext(device=args_dict['device'], num_threads=args_dict['num_threads'])
@@ -0,0 +1,80 @@
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from model_utils import predict
+
+
+def get_weighted_gradient(model, coeff, x, labels, criterion):
+    x = x.detach().requires_grad_(True)
+    predictions = predict(model.to(x.device), x)
+    loss = coeff * criterion(predictions, labels)
+    grad = torch.autograd.grad(loss.sum(), x)[0]
+    return loss.detach(), grad, coeff * predictions.detach()
+
+
+# Autograd node whose gradient was already computed by the ensemble executor, so that the ensemble loss
+# can be used like any other loss, e.g. behind an EOT transformation
+class PrecomputedGradient(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, loss, grad):
+        ctx.save_for_backward(grad)
+        return loss.clone()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad, = ctx.saved_tensors
+        return grad * grad_output.view(-1, *([1] * (grad.dim() - 1))), None, None
+
+
+class EnsembleExecutor:
+    def __init__(self, num_workers, num_threads=None):
+        self.num_workers = num_workers
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.streams = {}
+
+        # Intra-op threads are a process-wide setting - on CPU they are split between the workers while the
+        # ensemble runs, so that the concurrent surrogates do not oversubscribe the cores
+        if num_threads is None:
+            num_threads = max(1, torch.get_num_threads() // num_workers)
+        self.num_threads = num_threads
+
+    def get_stream(self, index, device):
+        key = (index % self.num_workers, device)
+        if key not in self.streams:
+            self.streams[key] = torch.cuda.Stream(device=device)
+        return self.streams[key]
+
+    def run_model(self, index, model, coeff, x, labels, criterion):
+        if not x.is_cuda:
+            return get_weighted_gradient(model, coeff, x, labels, criterion)
+
+        stream = self.get_stream(index, x.device)
+        with torch.cuda.stream(stream):
+            return get_weighted_gradient(model, coeff, x, labels, criterion)
+
+    # Returns the coefficient-weighted sums of the per-sample losses, of the input gradients and of the predictions
+    def __call__(self, models, coeffs, x, labels, criterion):
+        x = x.detach()
+        previous_num_threads = torch.get_num_threads()
+
+        if x.is_cuda:
+            for index in range(min(len(models), self.num_workers)):
+                self.get_stream(index, x.device).wait_stream(torch.cuda.current_stream(x.device))
+        else:
+            torch.set_num_threads(self.num_threads)
+
+        try:
+            futures = [self.pool.submit(self.run_model, index, model, coeff, x, labels, criterion)
+                       for index, (model, coeff) in enumerate(zip(models, coeffs))]
+            results = [future.result() for future in futures]
+        finally:
+            torch.set_num_threads(previous_num_threads)
+
+        if x.is_cuda:
+            for index in range(min(len(models), self.num_workers)):
+                torch.cuda.current_stream(x.device).wait_stream(self.get_stream(index, x.device))
+
+        losses, grads, predictions = zip(*results)
+        return torch.stack(losses).sum(dim=0), torch.stack(grads).sum(dim=0), torch.stack(predictions).sum(dim=0)
+
+    def shutdown(self):
+        self.pool.shutdown()
@@ -1,5 +1,7 @@
 import datetime
+import json
 import os
+import torch
 
 
 def get_current_time():
@@ -13,3 +15,50 @@ def validate_save_file_location(location):
     save_file_parent_directory = os.path.dirname(location)
     if not os.path.exists(save_file_parent_directory):
         os.makedirs(save_file_parent_directory)
+
+
+def get_shards_location(save_file_location):
+    return save_file_location[:-len('.pt')] + '_shards'
+
+
+def load_manifest(shards_location, name='manifest.json'):
+    manifest_location = os.path.join(shards_location, name)
+    if not os.path.exists(manifest_location):
+        return None
+
+    with open(manifest_location) as file:
+        return json.load(file)
+
+
+# The manifest and the shards are written to a temporary file first, so an interrupted run never leaves a
+# partially written file behind
+def save_manifest(shards_location, manifest, name='manifest.json'):
+    if not os.path.exists(shards_location):
+        os.makedirs(shards_location)
+
+    manifest_location = os.path.join(shards_location, name)
+    with open(manifest_location + '.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(manifest_location + '.tmp', manifest_location)
+
+
+def save_shard(shards_location, shard_index, shard):
+    if not os.path.exists(shards_location):
+        os.makedirs(shards_location)
+
+    shard_name = 'shard_{:05d}.pt'.format(shard_index)
+    shard_location = os.path.join(shards_location, shard_name)
+    torch.save(shard, shard_location + '.tmp')
+    os.replace(shard_location + '.tmp', shard_location)
+    return shard_name
+
+
+def merge_shards(shards_location, shard_names):
+    results = {'adversarial_examples': [], 'predictions': [], 'similarity': []}
+
+    for shard_name in shard_names:
+        shard = torch.load(os.path.join(shards_location, shard_name))
+        for key in results.keys():
+            results[key].extend(shard[key])
+
+    return results
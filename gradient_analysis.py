@@ -4,19 +4,23 @@ from model_utils import ARCHS_LIST, get_model, load_model, predict
 from file_utils import validate_save_file_location
 import argparse
 from pgd import get_current_time
+from device_utils import ExecutionContext
 import os
 
 
-def get_gradient(model, x, label, criterion, similarity_coeffs):
-    x = autograd.Variable(x, requires_grad=True).cuda()
+def get_gradient(model, x, label, criterion, similarity_coeffs, ensemble_executor=None):
+    x = x.detach().requires_grad_(True)
 
     if type(model) is list:
         if similarity_coeffs is None:
             similarity_coeffs = dict(zip([i for i in range(len(model))], [1 / len(model)] * len(model)))
 
-        loss = torch.zeros(1).cuda()
+        if ensemble_executor is not None:
+            _, grad, _ = ensemble_executor(model, list(similarity_coeffs.values()), x, label, criterion)
+            return grad
+
+        loss = torch.zeros(1, device=x.device)
         for arch, current_model in zip(similarity_coeffs.keys(), model):
-            current_model.cuda()
             prediction = predict(current_model, x)
             current_loss = criterion(prediction, label)
             loss = torch.add(loss, similarity_coeffs[arch] * current_loss)
@@ -25,7 +29,7 @@ def get_gradient(model, x, label, criterion, similarity_coeffs):
         loss = criterion(prediction, label)
 
     grad = autograd.grad(loss, x)[0]
-    return grad.cpu()
+    return grad
 
 
 def get_sorted_order(grad, size):
@@ -37,19 +41,22 @@ def get_sorted_order(grad, size):
     return order
 
 
-def get_grad_dict(model, criterion, args_dict):
+def get_grad_dict(model, criterion, args_dict, context):
     grads_dict = {}
 
     for category_file in os.listdir(args_dict['dataset']):
         category_grads = []
         if category_file.endswith('.pt'):
             dataset = torch.load(os.path.join(args_dict['dataset'], category_file))
+            if args_dict['cache_dataset']:
+                dataset.enable_cache()
 
             if dataset.__len__() == 0:
                 continue
             for image, _ in dataset:
-                prediction = predict(model, image.cuda())
-                label = torch.argmax(prediction, dim=1).cuda()
+                image = context.to_device(image)
+                prediction = predict(model, image)
+                label = torch.argmax(prediction, dim=1)
 
                 current_grad = get_gradient(model, image, label, criterion)
                 category_grads.append(current_grad.cpu())
@@ -60,15 +67,12 @@ def get_grad_dict(model, criterion, args_dict):
 
 
 def normalize_grad(grad):
-    mean_grad = torch.cuda.FloatTensor([[[torch.mean(grad[0])]],
-                                        [[torch.mean(grad[1])]],
-                                        [[torch.mean(grad[2])]]]).repeat(1, grad.size(1), grad.size(2))
-    std_grad = torch.cuda.FloatTensor([[[torch.std(grad[0])]],
-                                       [[torch.std(grad[1])]],
-                                       [[torch.std(grad[2])]]]).repeat(1, grad.size(1), grad.size(2))
+    # Per-channel statistics, on the device of the gradient
+    mean_grad = torch.mean(grad, dim=(-2, -1), keepdim=True)
+    std_grad = torch.std(grad, dim=(-2, -1), keepdim=True)
 
-    normalized_grad = (grad.cuda() - mean_grad) / std_grad
-    return normalized_grad.cpu()
+    normalized_grad = (grad - mean_grad) / std_grad
+    return normalized_grad
 
 
 def normalize_grads_dict(grads_dict):
@@ -119,19 +123,22 @@ def get_averages_by_category(grads_dict, args_dict):
     return categories_averages
 
 
-def get_averages_dict(model, criterion, args_dict):
+def get_averages_dict(model, criterion, args_dict, context):
     averages_dict = {}
 
     for category_file in os.listdir(args_dict['dataset']):
         category_grads = []
         if category_file.endswith('.pt'):
             dataset = torch.load(os.path.join(args_dict['dataset'], category_file))
+            if args_dict['cache_dataset']:
+                dataset.enable_cache()
 
             if dataset.__len__() == 0:
                 continue
             for image, _ in dataset:
-                prediction = predict(model, image.cuda())
-                label = torch.argmax(prediction, dim=1).cuda()
+                image = context.to_device(image)
+                prediction = predict(model, image)
+                label = torch.argmax(prediction, dim=1)
 
                 current_grad = get_gradient(model, image, label, criterion)
                 if args_dict['normalize_grads']:
@@ -153,22 +160,28 @@ def main():
     parser.add_argument('--checkpoint_location', type=str, default=None)
     parser.add_argument('--from_robustness', default=False, action='store_true')
     parser.add_argument('--dataset', type=str, default='dataset/coco')
+    parser.add_argument('--cache_dataset', default=False, action='store_true')
     parser.add_argument('--normalize_grads', default=False, action='store_true')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--num_threads', type=int, default=None)
     parser.add_argument('--save_file_location', type=str, default='results/gradient/' + time + '.pt')
     args_dict = vars(parser.parse_args())
 
     validate_save_file_location(args_dict['save_file_location'])
+    context = ExecutionContext(device=args_dict['device'], num_threads=args_dict['num_threads'])
+    context.apply_thread_settings()
 
     if args_dict['checkpoint_location'] is not None:
         model = load_model(location=args_dict['checkpoint_location'],
                            arch=args_dict['arch'],
-                           from_robustness=args_dict['from_robustness']).cuda().eval()
+                           from_robustness=args_dict['from_robustness'])
     else:
-        model = get_model(args_dict['arch'], 'standard' if [args_dict['pretrained']] else None).cuda().eval()
+        model = get_model(args_dict['arch'], 'standard' if [args_dict['pretrained']] else None)
+    model = context.prepare_model(model).eval()
 
     criterion = torch.nn.CrossEntropyLoss(reduction='none')
 
-    averages = get_averages_dict(model, criterion, args_dict)
+    averages = get_averages_dict(model, criterion, args_dict, context)
     torch.save({'averages': averages, 'args': args_dict},
                args_dict['save_file_location'])
 
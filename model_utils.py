@@ -2,6 +2,7 @@ import torch
 import torchvision
 from robustness.datasets import ImageNet
 from robustness.model_utils import make_and_restore_model
+from collections import OrderedDict
 import os
 import pretrainedmodels
 
@@ -75,6 +76,8 @@ OTHER_MODELS = [
 
 ARCHS_LIST = TORCHVISION_ARCHS + PRETRAINEDMODELS_ARCHS
 
+MODEL_REGISTRY_MEMORY_BUDGET = 8 * 1024 ** 3
+
 
 def predict(model, x):
     if len(x.size()) != 4:
@@ -152,6 +155,66 @@ def get_model(arch, parameters=None, freeze=False):
         raise ValueError('Specified model is not in the list of available ones!')
 
 
+def get_model_size(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+# Process-wide LRU cache of constructed, frozen models in eval mode, bounded by the memory of their weights
+class ModelRegistry:
+    def __init__(self, memory_budget=MODEL_REGISTRY_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.models = OrderedDict()
+        self.models_sizes = {}
+        self.memory_usage = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, arch, parameters='standard'):
+        key = (arch, str(parameters))
+        if key in self.models:
+            self.stats['hits'] += 1
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        self.stats['misses'] += 1
+        model = get_model(arch, parameters=parameters, freeze=True).eval()
+
+        self.models[key] = model
+        self.models_sizes[key] = get_model_size(model)
+        self.memory_usage += self.models_sizes[key]
+        self.evict()
+        return model
+
+    def evict(self):
+        # The most recently used model is never evicted, even if it alone exceeds the budget
+        while self.memory_usage > self.memory_budget and len(self.models) > 1:
+            key, _ = self.models.popitem(last=False)
+            self.memory_usage -= self.models_sizes.pop(key)
+            self.stats['evictions'] += 1
+
+    def set_memory_budget(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.evict()
+
+    def clear(self):
+        self.models.clear()
+        self.models_sizes.clear()
+        self.memory_usage = 0
+
+    def get_stats(self):
+        return {**self.stats,
+                'cached_models': len(self.models),
+                'memory_usage': self.memory_usage,
+                'memory_budget': self.memory_budget}
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def get_cached_model(arch, parameters='standard'):
+    return MODEL_REGISTRY.get(arch, parameters)
+
+
 def get_state_dict(location):
     obj = torch.load(location)
     if type(obj) == dict:
@@ -1,12 +1,18 @@
 import torch
+import torch.distributed
+import torch.multiprocessing
 import robustness
 from pgd_attack_steps import LinfStep, L2Step
-from model_utils import ARCHS_LIST, get_model, load_model, predict
-from dataset_utils import imagenet_mapping
-from transformations import get_random_transformation
-from file_utils import get_current_time, validate_save_file_location
-from collections import defaultdict
+from model_utils import ARCHS_LIST, MODEL_REGISTRY, get_model, get_cached_model, load_model, predict
+from dataset_utils import imagenet_mapping, create_bucketed_loader
+from transformations import get_random_transformation, ComposedTransformation, TransformationBank
+from ensemble_utils import EnsembleExecutor, PrecomputedGradient
+from device_utils import get_execution_context, get_num_available_cores
+from file_utils import (get_current_time, validate_save_file_location, get_shards_location, load_manifest,
+                        save_manifest, save_shard, merge_shards)
 import argparse
+import contextlib
+import datetime
 import random
 import copy
 import os
@@ -22,20 +28,41 @@ PARSER_ARGS = [
     {'name': '--num_samples', 'type': int, 'choices': None, 'default': 50, 'action': None},
     {'name': '--sigma', 'type': int, 'choices': None, 'default': 8, 'action': None},
     {'name': '--num_transformations', 'type': int, 'choices': None, 'default': 50, 'action': None},
+    {'name': '--scoring_batch_size', 'type': int, 'choices': None, 'default': 50, 'action': None},
     {'name': '--batch_size', 'type': int, 'choices': None, 'default': 2, 'action': None},
     {'name': '--masks', 'default': False, 'action': 'store_true'},
+    {'name': '--cache_dataset', 'default': False, 'action': 'store_true'},
+    {'name': '--bucket_granularity', 'type': int, 'choices': None, 'default': 1, 'action': None},
     {'name': '--eps', 'type': float, 'choices': None, 'default': 8, 'action': None},
     {'name': '--norm', 'type': str, 'choices': ['l2', 'linf'], 'default': 'linf', 'action': None},
     {'name': '--step_size', 'type': float, 'choices': None, 'default': 1, 'action': None},
     {'name': '--num_iterations', 'type': int, 'choices': None, 'default': 10, 'action': None},
+    {'name': '--num_restarts', 'type': int, 'choices': None, 'default': 1, 'action': None},
     {'name': '--unadversarial', 'default': False, 'action': 'store_true'},
     {'name': '--targeted', 'default': False, 'action': 'store_true'},
     {'name': '--eot', 'default': False, 'action': 'store_true'},
+    {'name': '--eot_transformations', 'type': str, 'choices': None, 'default': None, 'action': None},
+    {'name': '--eot_samples', 'type': int, 'choices': None, 'default': 1, 'action': None},
+    {'name': '--eot_memory_budget', 'type': int, 'choices': None, 'default': 4096, 'action': None},
+    {'name': '--eot_bank_size', 'type': int, 'choices': None, 'default': 0, 'action': None},
+    {'name': '--eot_bank_seed', 'type': int, 'choices': None, 'default': 0, 'action': None},
     {'name': '--transfer', 'default': False, 'action': 'store_true'},
     {'name': '--selective', 'default': False, 'action': 'store_true'},
     {'name': '--similarity_coeffs', 'default': False, 'action': 'store_true'},
     {'name': '--num_surrogates', 'type': int, 'choices': None, 'default': 5, 'action': None},
-    {'name': '--save_file_location', 'type': int, 'choices': None, 'default': None, 'action': None},
+    {'name': '--ensemble_workers', 'type': int, 'choices': None, 'default': 0, 'action': None},
+    {'name': '--model_cache_memory', 'type': int, 'choices': None, 'default': 8192, 'action': None},
+    {'name': '--early_stopping', 'default': False, 'action': 'store_true'},
+    {'name': '--fast_attack', 'default': False, 'action': 'store_true'},
+    {'name': '--save_file_location', 'type': str, 'choices': None, 'default': None, 'action': None},
+    {'name': '--shard_size', 'type': int, 'choices': None, 'default': 10, 'action': None},
+    {'name': '--resume', 'default': False, 'action': 'store_true'},
+    {'name': '--num_processes', 'type': int, 'choices': None, 'default': 1, 'action': None},
+    {'name': '--num_nodes', 'type': int, 'choices': None, 'default': 1, 'action': None},
+    {'name': '--node_rank', 'type': int, 'choices': None, 'default': 0, 'action': None},
+    {'name': '--dist_url', 'type': str, 'choices': None, 'default': 'tcp://127.0.0.1:29500', 'action': None},
+    {'name': '--device', 'type': str, 'choices': None, 'default': None, 'action': None},
+    {'name': '--num_threads', 'type': int, 'choices': None, 'default': None, 'action': None},
 ]
 
 PGD_DEFAULT_ARGS_DICT = {
@@ -46,20 +73,41 @@ PGD_DEFAULT_ARGS_DICT = {
     'num_samples': 500,
     'sigma': 0.03137254901960784,
     'num_transformations': 50,
+    'scoring_batch_size': 50,
     'batch_size': 2,
     'masks': False,
+    'cache_dataset': False,
+    'bucket_granularity': 1,
     'eps': 0.03137254901960784,
     'norm': 'linf',
     'step_size': 0.00392156862745098,
     'num_iterations': 10,
+    'num_restarts': 1,
     'unadversarial': False,
     'targeted': False,
     'eot': False,
+    'eot_transformations': None,
+    'eot_samples': 1,
+    'eot_memory_budget': 4096,
+    'eot_bank_size': 0,
+    'eot_bank_seed': 0,
     'transfer': False,
     'selective': False,
     'similarity_coeffs': False,
     'num_surrogates': 5,
+    'ensemble_workers': 0,
+    'model_cache_memory': 8192,
+    'early_stopping': False,
+    'fast_attack': False,
     'save_file_location': 'results/pgd_new_experiments/test.py',
+    'shard_size': 10,
+    'resume': False,
+    'num_processes': 1,
+    'num_nodes': 1,
+    'node_rank': 0,
+    'dist_url': 'tcp://127.0.0.1:29500',
+    'device': None,
+    'num_threads': None,
     'restart_iterations': 10
      }
 
@@ -89,6 +137,10 @@ def normalize_args_dict(args_dict):
         args_dict['save_file_location'] = 'results/pgd_new_experiments/' + time + '.pt'
     validate_save_file_location(args_dict['save_file_location'])
 
+    # The ImageNet runs load the dataset through robustness, whose datasets have no decoded cache
+    if args_dict['cache_dataset'] and not args_dict['masks']:
+        raise ValueError('--cache_dataset is only supported with --masks!')
+
     if args_dict['norm'] == 'linf':
         args_dict['eps'] = args_dict['eps'] / 255.0
     args_dict['step_size'] = args_dict['step_size'] / 255.0
@@ -102,14 +154,46 @@ def normalize_args_dict(args_dict):
     return args_dict
 
 
+# Adds up the bytes of the tensors autograd saves for the backward pass, which is most of the memory a forward pass
+# keeps alive until the backward pass. Saved tensor hooks need torch 1.10 - with older versions nothing is measured.
+class SavedTensorsMeter:
+    def __init__(self):
+        self.num_bytes = None
+        self.hooks = None
+        if hasattr(torch.autograd, 'graph') and hasattr(torch.autograd.graph, 'saved_tensors_hooks'):
+            self.num_bytes = 0
+            self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+
+    def pack(self, tensor):
+        self.num_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    @staticmethod
+    def unpack(tensor):
+        return tensor
+
+    def __enter__(self):
+        if self.hooks is not None:
+            self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        if self.hooks is not None:
+            self.hooks.__exit__(*args)
+
+
 class Attacker:
     def __init__(self, model, args_dict, attack_step=LinfStep, mask_batch=None):
         self.model = model
         self.args_dict = args_dict
+        self.context = get_execution_context(args_dict)
         self.similarity_coeffs = {}
+        self.ensemble_executor = None
 
         if args_dict['transfer']:
             self.loss = self.transfer_loss
+            if args_dict['ensemble_workers'] > 0:
+                self.ensemble_executor = EnsembleExecutor(args_dict['ensemble_workers'])
             self.available_surrogates_list = copy.copy(ARCHS_LIST)
             self.available_surrogates_list.remove(args_dict['arch'])
 
@@ -118,7 +202,7 @@ class Attacker:
                 coeffs = [1 / len(surrogates_list)] * len(surrogates_list)
                 self.similarity_coeffs = (dict(zip(surrogates_list, coeffs)))
                 ALL_SIMILARITY_COEFFS.append(self.similarity_coeffs)
-                self.surrogate_models = [get_model(arch, parameters='standard', freeze=True).eval()
+                self.surrogate_models = [self.context.prepare_model(get_cached_model(arch))
                                          for arch in surrogates_list]
             else:
                 self.args_dict['label_shifts'] = 0
@@ -128,90 +212,203 @@ class Attacker:
         if args_dict['norm'] == 'l2':
             attack_step = L2Step
 
-        self.criterion = torch.nn.CrossEntropyLoss()
+        self.criterion = torch.nn.CrossEntropyLoss(reduction='none')
         self.optimization_direction = -1 if args_dict['unadversarial'] or args_dict['targeted'] else 1
         self.mask_batch = mask_batch
         self.attack_step = attack_step
+        self.eot_copies_per_chunk = {}
+        self.eot_transformation = None
+        if args_dict['eot_bank_size'] > 0:
+            transformation_types = None
+            if args_dict['eot_transformations'] is not None:
+                transformation_types = args_dict['eot_transformations'].split(',')
+            self.eot_transformation = TransformationBank(transformation_types,
+                                                         args_dict['eot_bank_size'],
+                                                         args_dict['eot_bank_seed'])
+        elif args_dict['eot_transformations'] is not None:
+            self.eot_transformation = ComposedTransformation(args_dict['eot_transformations'].split(','))
 
     def __call__(self, image_batch, mask_batch, targets, random_start=False):
-        best_loss = None
-        best_x = None
+        if self.args_dict['transfer'] and self.args_dict['selective']:
+            step = self.attack_step(image_batch, self.args_dict['eps'], self.args_dict['step_size'])
+            self.surrogate_models = self.selective_transfer(image_batch,
+                                                            mask_batch,
+                                                            targets,
+                                                            step)
+
+        attack = self.fast_attack if self.args_dict['fast_attack'] else self.attack
 
+        num_restarts = self.args_dict['num_restarts']
+        if num_restarts == 1:
+            best_x, _, _ = attack(image_batch, mask_batch, targets, random_start)
+            return best_x
+
+        # Every sample is replicated num_restarts times with independent random starts and all replicas are
+        # attacked as a single batch, restart-major: [r0 b0, r0 b1, ..., r1 b0, ...]
+        batch_size = image_batch.size(0)
+        best_x, best_loss, successful = attack(image_batch.repeat(num_restarts, 1, 1, 1),
+                                               mask_batch.repeat(num_restarts, 1, 1, 1),
+                                               targets.repeat(num_restarts),
+                                               random_start=True)
+
+        scores = torch.where(successful, torch.full_like(best_loss, float('inf')), best_loss)
+        best_restarts = torch.argmax(scores.view(num_restarts, batch_size), dim=0)
+        best_x = best_x.view(num_restarts, batch_size, *best_x.size()[1:])
+        return best_x[best_restarts, torch.arange(batch_size, device=best_x.device)]
+
+    def attack(self, image_batch, mask_batch, targets, random_start=False):
         step = self.attack_step(image_batch, self.args_dict['eps'], self.args_dict['step_size'])
 
         if random_start:
             image_batch = step.random_perturb(image_batch, mask_batch)
 
-        x = image_batch.clone().detach().requires_grad_(True)
+        x = image_batch.clone().detach()
+        best_x = image_batch.clone().detach()
+        best_loss = torch.full([image_batch.size(0)], -float('inf'), device=image_batch.device)
+        successful_samples = torch.zeros([image_batch.size(0)], dtype=torch.bool, device=image_batch.device)
 
-        if self.args_dict['transfer'] and self.args_dict['selective']:
-            self.surrogate_models = self.selective_transfer(image_batch,
-                                                            mask_batch,
-                                                            targets,
-                                                            step)
-            step.eps = self.args_dict['eps']
-
-        iterations_without_updates = 0
+        # Indices (into the original batch) of the samples that are still being attacked
+        active = torch.arange(image_batch.size(0), device=image_batch.device)
+        iterations_without_updates = torch.zeros_like(active)
+        active_images, active_masks, active_targets = image_batch, mask_batch, targets
 
         for iteration in range(self.args_dict['num_iterations']):
-            if iterations_without_updates == self.args_dict['restart_iterations']:
-                x = step.random_perturb(image_batch, mask_batch)
+            restart = torch.eq(iterations_without_updates, self.args_dict['restart_iterations'])
+            if restart.any():
+                restarted_x = step.random_perturb(active_images, active_masks).to(x.device)
+                x = torch.where(restart.view(-1, 1, 1, 1), restarted_x, x)
 
             x = x.clone().detach().requires_grad_(True)
+            x.register_hook(lambda grad: grad * active_masks.float())
 
             if self.args_dict['eot']:
-                t = get_random_transformation()
-                loss = self.loss(t(x.cuda()), targets)
+                loss, predictions = self.eot_loss(x, active_targets)
             else:
-                loss = self.loss(x.cuda(), targets)
-
-            x.register_hook(lambda grad: grad * mask_batch.float())
-            loss.backward()
+                loss, predictions = self.loss(x, active_targets)
+                loss.sum().backward()
 
             grads = x.grad.detach().clone()
             x.grad.zero_()
 
-            if best_loss is not None:
-                if best_loss < loss:
-                    best_loss = loss
-                    best_x = x.clone().detach()
-                    iterations_without_updates = -1
+            loss = loss.detach().to(best_loss.device)
+            improved = torch.gt(loss, best_loss[active])
+            best_loss[active] = torch.where(improved, loss, best_loss[active])
+            best_x[active[improved]] = x.detach()[improved]
+            iterations_without_updates = torch.where(improved,
+                                                     torch.zeros_like(iterations_without_updates),
+                                                     iterations_without_updates + 1)
+
+            if self.args_dict['early_stopping']:
+                # The iterate that met the attack goal is kept, even if an earlier one had a higher loss
+                successful = self.is_successful(predictions.detach(), active_targets).to(active.device)
+                best_x[active[successful]] = x.detach()[successful]
+                successful_samples[active[successful]] = True
             else:
-                best_loss = loss.clone().detach()
-                best_x = x.clone().detach()
-                iterations_without_updates = -1
+                successful = torch.zeros_like(improved)
 
-            iterations_without_updates += 1
+            if successful.all():
+                break
 
             x = step.step(x, grads)
             x = step.project(x)
 
-        return best_x.cuda()
+            if successful.any():
+                remaining = ~successful
+                active = active[remaining]
+                x = x[remaining]
+                iterations_without_updates = iterations_without_updates[remaining]
+                active_images, active_masks = active_images[remaining], active_masks[remaining]
+                active_targets = active_targets[remaining.to(active_targets.device)]
+                step.orig_x = step.orig_x[remaining]
+
+        return best_x, best_loss, successful_samples
+
+    # Same attack as self.attack, but the iterate and its gradient live in buffers allocated once per batch and
+    # the mask, step and projection are applied in place. The batch size is fixed, so with early stopping the
+    # successful samples are frozen instead of removed from the batch.
+    def fast_attack(self, image_batch, mask_batch, targets, random_start=False):
+        image_batch = self.context.to_device(image_batch)
+        step = self.attack_step(image_batch, self.args_dict['eps'], self.args_dict['step_size'])
+
+        if random_start:
+            image_batch = step.random_perturb(image_batch, mask_batch)
+
+        # A copy, since the masks of finished samples are zeroed below and the caller may reuse mask_batch
+        mask = mask_batch.to(image_batch, copy=True)
+        x = image_batch.clone().requires_grad_(True)
+        x.grad = torch.zeros_like(x)
+
+        best_x = image_batch.clone()
+        best_loss = torch.full([image_batch.size(0)], -float('inf'), device=image_batch.device)
+        successful_samples = torch.zeros([image_batch.size(0)], dtype=torch.bool, device=image_batch.device)
+        iterations_without_updates = torch.zeros([image_batch.size(0)], dtype=torch.long, device=image_batch.device)
+
+        for iteration in range(self.args_dict['num_iterations']):
+            with torch.no_grad():
+                restart = torch.eq(iterations_without_updates, self.args_dict['restart_iterations'])
+                restart &= ~successful_samples
+                if restart.any():
+                    x[restart] = step.random_perturb(image_batch, mask_batch)[restart]
+
+            # The gradient is accumulated into the existing x.grad buffer
+            x.grad.zero_()
+            if self.args_dict['eot']:
+                loss, predictions = self.eot_loss(x, targets)
+            else:
+                loss, predictions = self.loss(x, targets)
+                loss.sum().backward()
+
+            with torch.no_grad():
+                loss = loss.detach()
+                improved = torch.gt(loss, best_loss) & ~successful_samples
+                if improved.any():
+                    best_loss[improved] = loss[improved]
+                    best_x[improved] = x[improved]
+                iterations_without_updates.add_(1).masked_fill_(improved, 0)
+
+                if self.args_dict['early_stopping']:
+                    successful = self.is_successful(predictions.detach(), targets) & ~successful_samples
+                    if successful.any():
+                        best_x[successful] = x[successful]
+                        successful_samples |= successful
+                        mask[successful] = 0
+                    if successful_samples.all():
+                        break
+
+                x.grad.mul_(mask)
+                step.step_(x, x.grad)
+                step.project_(x)
+
+        return best_x, best_loss, successful_samples
 
     def selective_transfer(self, image_batch, mask_batch, original_labels, step):
-        model_scores = {}
-        model_scores = defaultdict(lambda: 0, model_scores)
-        mse_criterion = torch.nn.MSELoss(reduction='mean')
-        batch_indices = torch.arange(image_batch.size(0))
+        num_transformations = self.args_dict['num_transformations']
+        batch_size = image_batch.size(0)
+        batch_indices = torch.arange(num_transformations * batch_size)
 
         step.eps = self.args_dict['sigma']
 
-        for iteration in range(self.args_dict['num_transformations']):
-            x = image_batch.clone().detach().requires_grad_(False)
-            x = step.random_perturb(x, mask_batch)
+        # All perturbations of the batch are scored at once, transformation-major: [t0 b0, t0 b1, ..., t1 b0, ...]
+        x = torch.cat([step.random_perturb(image_batch.clone().detach(), mask_batch)
+                       for _ in range(num_transformations)])
 
-            predictions = predict(self.model.cuda(), x.cuda())
-            labels = torch.argmax(predictions, dim=1)
+        predictions = self.predict_in_chunks(self.model, x)
+        labels = torch.argmax(predictions, dim=1)
+        target_values = predictions[batch_indices, labels]
 
-            self.args_dict['label_shifts'] += (len(labels) - torch.sum(torch.eq(labels, original_labels)).item())
+        self.args_dict['label_shifts'] += (len(labels) -
+                                           torch.sum(torch.eq(labels, original_labels.repeat(num_transformations)))
+                                           .item())
 
-            for arch in self.available_surrogates_list:
-                current_model = get_model(arch, 'standard', freeze=True).cuda().eval()
-                current_predictions = predict(current_model, x)
+        surrogates_values = []
+        for arch in self.available_surrogates_list:
+            current_predictions = self.predict_in_chunks(self.context.prepare_model(get_cached_model(arch)), x)
+            surrogates_values.append(current_predictions[batch_indices, labels])
 
-                current_loss = mse_criterion(current_predictions[batch_indices, labels],
-                                             predictions[batch_indices, labels])
-                model_scores[arch] += current_loss
+        # Squared errors are averaged over the batch and summed over the transformations for every surrogate
+        squared_errors = (torch.stack(surrogates_values) - target_values.unsqueeze(0)) ** 2
+        scores = squared_errors.view(-1, num_transformations, batch_size).mean(dim=2).sum(dim=1)
+        model_scores = dict(zip(self.available_surrogates_list, scores.tolist()))
 
         surrogates_list = [arch
                            for arch in sorted(model_scores, key=model_scores.get)
@@ -226,88 +423,280 @@ class Attacker:
         self.similarity_coeffs = (dict(zip(surrogates_list, coeffs)))
         ALL_SIMILARITY_COEFFS.append(self.similarity_coeffs)
 
-        surrogate_models = [get_model(arch, parameters='standard', freeze=True).eval()
-                            for arch in surrogates_list]
+        surrogate_models = [self.context.prepare_model(get_cached_model(arch)) for arch in surrogates_list]
         return surrogate_models
 
+    def predict_in_chunks(self, model, x):
+        with torch.no_grad():
+            return torch.cat([predict(model, self.context.to_device(x_chunk))
+                              for x_chunk in torch.split(x, self.args_dict['scoring_batch_size'])])
+
+    def is_successful(self, predictions, targets):
+        labels = torch.argmax(predictions, dim=1)
+        if self.optimization_direction == -1:
+            return torch.eq(labels, targets)
+        return ~torch.eq(labels, targets)
+
+    def eot_loss(self, x, labels):
+        # Averages the loss over eot_samples random transformations of x. The transformed copies are stacked
+        # along the batch dimension and backpropagated in chunks, so x.grad holds the averaged gradient. The chunks
+        # fit in eot_memory_budget MB - the memory of a copy is measured with the first chunk, which holds a single
+        # one, from the allocator statistics on CUDA and from the tensors saved for the backward pass elsewhere.
+        num_copies = self.args_dict['eot_samples']
+        copies_per_chunk = self.eot_copies_per_chunk.get(tuple(x.size()))
+        loss_sum = torch.zeros([x.size(0)], device=x.device)
+        predictions_sum = None
+        copies_done = 0
+
+        while copies_done < num_copies:
+            memory_meter = contextlib.nullcontext()
+            if copies_per_chunk is None:
+                num_chunk_copies = 1
+                if x.is_cuda:
+                    torch.cuda.reset_peak_memory_stats(x.device)
+                    memory_baseline = torch.cuda.memory_allocated(x.device)
+                else:
+                    memory_meter = SavedTensorsMeter()
+            else:
+                num_chunk_copies = min(copies_per_chunk, num_copies - copies_done)
+
+            with memory_meter:
+                if self.eot_transformation is None:
+                    x_transformed = torch.cat([get_random_transformation()(x) for _ in range(num_chunk_copies)])
+                else:
+                    # The composed transformation and the bank draw their parameters per sample, so all copies are
+                    # warped at once
+                    x_transformed = self.eot_transformation(x.repeat(num_chunk_copies, 1, 1, 1))
+                loss, predictions = self.loss(x_transformed, labels.repeat(num_chunk_copies))
+            (loss.sum() / num_copies).backward()
+
+            loss_sum += loss.detach().view(num_chunk_copies, -1).sum(dim=0)
+            chunk_predictions_sum = predictions.detach().view(num_chunk_copies, x.size(0), -1).sum(dim=0)
+            if predictions_sum is None:
+                predictions_sum = chunk_predictions_sum
+            else:
+                predictions_sum += chunk_predictions_sum
+
+            if copies_per_chunk is None:
+                if x.is_cuda:
+                    copy_memory = max(torch.cuda.max_memory_allocated(x.device) - memory_baseline, 1)
+                elif memory_meter.num_bytes is not None:
+                    copy_memory = max(memory_meter.num_bytes, 1)
+                else:
+                    # Without a measurement, one copy per chunk is the only size known to fit in the budget
+                    copy_memory = self.args_dict['eot_memory_budget'] * 1024 ** 2
+                copies_per_chunk = max(1, int(self.args_dict['eot_memory_budget'] * 1024 ** 2 // copy_memory))
+                self.eot_copies_per_chunk[tuple(x.size())] = copies_per_chunk
+
+            copies_done += num_chunk_copies
+
+        return loss_sum / num_copies, predictions_sum / num_copies
+
     def normal_loss(self, x, labels):
         predictions = predict(self.model, x)
         loss = self.optimization_direction * self.criterion(predictions, labels)
-        return loss
+        return loss, predictions
 
     def transfer_loss(self, x, labels):
-        loss = torch.zeros([1]).cuda()
+        if self.ensemble_executor is not None:
+            coeffs = [self.similarity_coeffs[arch] for arch in self.similarity_coeffs.keys()]
+            loss, grad, ensemble_predictions = self.ensemble_executor(self.surrogate_models, coeffs, x,
+                                                                      labels, self.criterion)
+            loss = PrecomputedGradient.apply(x, self.optimization_direction * loss,
+                                             self.optimization_direction * grad)
+            return loss, ensemble_predictions
+
+        loss = torch.zeros([x.size(0)], device=x.device)
+        ensemble_predictions = None
 
         for arch, current_model in zip(self.similarity_coeffs.keys(), self.surrogate_models):
-            current_model.cuda()
             predictions = predict(current_model, x)
 
             current_loss = self.criterion(predictions, labels)
             loss = torch.add(loss, self.optimization_direction * self.similarity_coeffs[arch] * current_loss)
 
-        return loss
+            weighted_predictions = self.similarity_coeffs[arch] * predictions.detach()
+            if ensemble_predictions is None:
+                ensemble_predictions = weighted_predictions
+            else:
+                ensemble_predictions = ensemble_predictions + weighted_predictions
 
+        return loss, ensemble_predictions
 
-def main():
-    args_dict = normalize_args_dict(get_args_dict())
-
-    print('Running PGD experiment with the following arguments:')
-    print(str(args_dict) + '\n')
 
+def load_target_model(args_dict, context):
     if args_dict['checkpoint_location'] is None:
-        model = get_model(arch=args_dict['arch'], parameters='standard', freeze=True).cuda().eval()
+        model = get_model(arch=args_dict['arch'], parameters='standard', freeze=True)
     else:
         model = load_model(location=args_dict['checkpoint_location'],
                            arch=args_dict['arch'],
-                           from_robustness=args_dict['from_robustness']).cuda().eval()
+                           from_robustness=args_dict['from_robustness'])
+    return context.prepare_model(model).eval()
 
-    attacker = Attacker(model, args_dict)
 
-    print('Loading dataset...')
+# Returns the batch on the device of the context together with the labels predicted by the model, if predict_labels
+# is set
+def get_clean_batch(model, batch, masks, context, predict_labels=True):
+    if masks:
+        image_batch, mask_batch = batch
+        if mask_batch.size() != image_batch.size():
+            mask_batch = torch.ones_like(image_batch)
+    else:
+        image_batch, label_batch = batch
+        mask_batch = torch.ones_like(image_batch)
+
+    image_batch = context.to_device(image_batch)
+    mask_batch = context.to_device(mask_batch)
+
+    predicted_label_batch = None
+    if predict_labels or masks:
+        predicted_label_batch = torch.argmax(predict(model, image_batch), dim=1)
+
+    if masks:
+        label_batch = predicted_label_batch
+
+    return image_batch, mask_batch, label_batch.to(image_batch.device), predicted_label_batch
+
+
+# Keeps only the correctly classified images of untargeted attacks and returns the batch with the attack targets,
+# or None if no image is left
+def select_attack_batch(args_dict, image_batch, mask_batch, label_batch, predicted_label_batch):
+    if not args_dict['targeted'] and not args_dict['masks']:
+        matching_labels = torch.eq(label_batch, predicted_label_batch)
+        num_matching_labels = torch.sum(matching_labels)
+        if num_matching_labels == 0:
+            return None
+
+        image_batch, mask_batch, label_batch = (image_batch[matching_labels],
+                                                mask_batch[matching_labels],
+                                                label_batch[matching_labels])
+        targets = label_batch
+    else:
+        targets = TARGET_CLASS * torch.ones_like(label_batch)
+
+    return image_batch, mask_batch, label_batch, targets
+
+
+# The loader workers of the processes of a node share its cores, like their threads do
+def get_num_loader_workers(args_dict):
+    return max(1, min(10, get_num_available_cores() // args_dict['num_processes']))
+
+
+# Every worker gets a disjoint shard of the dataset - the batches of a bucketed loader, or the images of a shuffled
+# ImageNet loader. The shuffling only depends on the seed, which all workers share. The batches before start_batch
+# are skipped by the sampler, so a resumed run does not load them again.
+def get_loader(args_dict, seed, rank=0, world_size=1, start_batch=0):
+    num_workers = get_num_loader_workers(args_dict)
     if args_dict['masks']:
-        loader = torch.load(args_dict['dataset'])
+        dataset = torch.load(args_dict['dataset'])
+        if args_dict['cache_dataset']:
+            dataset.enable_cache()
+        loader = create_bucketed_loader(dataset,
+                                        batch_size=args_dict['batch_size'],
+                                        num_workers=num_workers,
+                                        granularity=args_dict['bucket_granularity'],
+                                        num_shards=world_size,
+                                        shard_index=rank,
+                                        start_batch=start_batch)
     else:
         label_mapping = None
         if not os.path.exists(os.path.join(args_dict['dataset'], 'val')):
             label_mapping = imagenet_mapping
         dataset = robustness.datasets.ImageNet(args_dict['dataset'], label_mapping=label_mapping)
-        loader, _ = dataset.make_loaders(workers=10, batch_size=args_dict['batch_size'])
+        loader, _ = dataset.make_loaders(workers=num_workers, batch_size=args_dict['batch_size'])
+
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        indices = torch.randperm(len(loader.dataset), generator=generator)[rank::world_size]
+        indices = indices[start_batch * args_dict['batch_size']:].tolist()
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(loader.dataset, indices),
+                                             batch_size=args_dict['batch_size'],
+                                             num_workers=num_workers)
+    return loader
+
+
+def get_rank_shards_location(args_dict, rank, world_size):
+    shards_location = get_shards_location(args_dict['save_file_location'])
+    if world_size == 1:
+        return shards_location
+    return os.path.join(shards_location, 'rank_' + str(rank))
+
+
+# The seed is stored before any work is done, so that a resumed run shuffles the dataset in the same way
+def get_seed(args_dict, world_size):
+    shards_location = get_shards_location(args_dict['save_file_location'])
+    run_manifest = load_manifest(shards_location, 'run.json') if args_dict['resume'] else None
+
+    if run_manifest is None:
+        run_manifest = {'seed': random.randrange(2 ** 31), 'world_size': world_size}
+        save_manifest(shards_location, run_manifest, 'run.json')
+    elif run_manifest['world_size'] != world_size:
+        raise ValueError('A run can only be resumed with the same number of workers!')
+
+    return run_manifest['seed']
+
+
+def run(args_dict, seed, rank=0, world_size=1):
+    # Results are streamed to shard files of shard_size batches each, and the manifest records the completed shards,
+    # the loader position and whether the run finished, so that an interrupted run can be continued with --resume
+    shards_location = get_rank_shards_location(args_dict, rank, world_size)
+    manifest = load_manifest(shards_location) if args_dict['resume'] else None
+    if manifest is None:
+        manifest = {'shards': [], 'next_batch_index': 0, 'finished': False}
+    else:
+        if 'label_shifts' in manifest['args_dict']:
+            args_dict['label_shifts'] = manifest['args_dict']['label_shifts']
+        if manifest.get('finished', False):
+            print('The run is already finished!\n')
+            return
+        print('Resuming from batch ' + str(manifest['next_batch_index']) + '...')
+
+    MODEL_REGISTRY.set_memory_budget(args_dict['model_cache_memory'] * 1024 ** 2)
+
+    context = get_execution_context(args_dict)
+    context.apply_thread_settings()
+    model = load_target_model(args_dict, context)
+
+    # The surrogates are sampled with the seed of the run, so every rank and every resumed run attacks with the same
+    # ones, and their coefficients are only recorded by the first shard of rank 0
+    random.seed(seed)
+    attacker = Attacker(model, args_dict)
+    if rank > 0 or len(manifest['shards']) > 0:
+        ALL_SIMILARITY_COEFFS.clear()
 
+    print('Loading dataset...')
+    loader = get_loader(args_dict, seed, rank, world_size, manifest['next_batch_index'])
+    num_samples = -(-args_dict['num_samples'] // world_size)
     print('Finished!\n')
+
+    def save_results_shard(next_batch_index):
+        shard_name = save_shard(shards_location, len(manifest['shards']),
+                                {'adversarial_examples': adversarial_examples_list,
+                                 'predictions': predictions_list,
+                                 'similarity': list(ALL_SIMILARITY_COEFFS)})
+        manifest['shards'].append(shard_name)
+        manifest['next_batch_index'] = next_batch_index
+        manifest['args_dict'] = args_dict
+        save_manifest(shards_location, manifest)
+
+        adversarial_examples_list.clear()
+        predictions_list.clear()
+        ALL_SIMILARITY_COEFFS.clear()
+
     adversarial_examples_list = []
     predictions_list = []
 
-    print('Starting PGD...')
-    for index, batch in enumerate(loader):
-        if args_dict['masks']:
-            image_batch, mask_batch = batch
-            image_batch.unsqueeze_(0)
-            mask_batch.unsqueeze_(0)
-
-            label_batch = torch.argmax(predict(model, image_batch.cuda()), dim=1)
-            if mask_batch.size != image_batch.size():
-                mask_batch = torch.ones_like(image_batch)
-        else:
-            image_batch, label_batch = batch
-            mask_batch = torch.ones_like(image_batch)
+    random.seed(seed + rank)
+    torch.manual_seed(seed + rank)
 
-        image_batch = image_batch.cuda()
-        mask_batch = mask_batch.cuda()
-        label_batch = label_batch.cuda()
-
-        if not args_dict['targeted'] and not args_dict['masks']:
-            predicted_label_batch = torch.argmax(predict(model, image_batch), dim=1)
-            matching_labels = torch.eq(label_batch, predicted_label_batch)
-            num_matching_labels = torch.sum(matching_labels)
-            if num_matching_labels == 0:
-                continue
-
-            image_batch, mask_batch, label_batch = (image_batch[matching_labels],
-                                                    mask_batch[matching_labels],
-                                                    label_batch[matching_labels])
-            targets = label_batch
-        else:
-            targets = TARGET_CLASS * torch.ones_like(label_batch)
+    print('Starting PGD...')
+    index = manifest['next_batch_index'] - 1
+    for index, batch in enumerate(loader, manifest['next_batch_index']):
+        clean_batch = get_clean_batch(model, batch, args_dict['masks'], context, not args_dict['targeted'])
+        attack_batch = select_attack_batch(args_dict, *clean_batch)
+        if attack_batch is None:
+            continue
+        image_batch, mask_batch, label_batch, targets = attack_batch
 
         adversarial_examples = attacker(image_batch, mask_batch, targets, False)
         adversarial_predictions = predict(model, adversarial_examples)
@@ -316,18 +705,104 @@ def main():
         predictions_list.append({'original': label_batch.cpu(),
                                  'adversarial': adversarial_predictions.cpu()})
 
-        if (index + 2) * image_batch.size(0) > args_dict['num_samples']:
+        if len(adversarial_examples_list) == args_dict['shard_size']:
+            save_results_shard(index + 1)
+
+        if (index + 2) * image_batch.size(0) > num_samples:
             break
 
+    if len(adversarial_examples_list) > 0 or len(ALL_SIMILARITY_COEFFS) > 0:
+        save_results_shard(index + 1)
+
+    manifest['finished'] = True
+    manifest['args_dict'] = args_dict
+    save_manifest(shards_location, manifest)
+
     print('Finished!')
+    print('Model cache statistics: ' + str(MODEL_REGISTRY.get_stats()) + '\n')
+
+
+# The shards of all workers are merged into a single results file with the same format as a single-process run.
+# With several nodes, the results location has to be on a filesystem shared by all of them.
+def save_results(args_dict, world_size):
+    results = {'adversarial_examples': [], 'predictions': [], 'similarity': []}
+
+    for rank in range(world_size):
+        shards_location = get_rank_shards_location(args_dict, rank, world_size)
+        manifest = load_manifest(shards_location)
+        if manifest is None:
+            continue
 
-    print('Serializing results...')
-    torch.save({'adversarial_examples': adversarial_examples_list,
-                'predictions': predictions_list,
-                'similarity': ALL_SIMILARITY_COEFFS,
+        rank_results = merge_shards(shards_location, manifest['shards'])
+        for key in results.keys():
+            results[key].extend(rank_results[key])
+
+        if rank > 0 and 'label_shifts' in manifest['args_dict']:
+            args_dict['label_shifts'] += manifest['args_dict']['label_shifts']
+
+    torch.save({'adversarial_examples': results['adversarial_examples'],
+                'predictions': results['predictions'],
+                'similarity': results['similarity'],
                 'args_dict': args_dict},
                args_dict['save_file_location'])
-    print('Finished!\n')
+
+
+# Only rank 0 builds the decoded cache of the dataset, and the other ranks wait until it is complete, so that they
+# only open it
+def build_dataset_cache(args_dict, rank):
+    if rank == 0:
+        torch.load(args_dict['dataset']).enable_cache()
+    torch.distributed.barrier()
+
+
+def run_worker(local_rank, args_dict):
+    world_size = args_dict['num_nodes'] * args_dict['num_processes']
+    rank = args_dict['node_rank'] * args_dict['num_processes'] + local_rank
+
+    device = args_dict['device'] or ('cuda' if torch.cuda.is_available() else 'cpu')
+    if device.startswith('cuda'):
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    elif args_dict['num_threads'] is None:
+        # The workers of a node share its cores
+        args_dict['num_threads'] = max(1, get_num_available_cores() // args_dict['num_processes'])
+
+    seed = get_seed(args_dict, world_size) if rank == 0 else 0
+    if world_size > 1:
+        # The ranks wait for each other at the barrier after their shards, which can finish hours apart, so the
+        # default 30 minute timeout is far too short
+        torch.distributed.init_process_group('gloo',
+                                             init_method=args_dict['dist_url'],
+                                             rank=rank,
+                                             world_size=world_size,
+                                             timeout=datetime.timedelta(days=7))
+        seed_tensor = torch.LongTensor([seed])
+        torch.distributed.broadcast(seed_tensor, src=0)
+        seed = seed_tensor.item()
+
+        if args_dict['cache_dataset']:
+            build_dataset_cache(args_dict, rank)
+
+    run(args_dict, seed, rank, world_size)
+
+    if world_size > 1:
+        torch.distributed.barrier()
+
+    if rank == 0:
+        print('Serializing results...')
+        save_results(args_dict, world_size)
+        print('Finished!\n')
+
+
+def main():
+    args_dict = normalize_args_dict(get_args_dict())
+
+    print('Running PGD experiment with the following arguments:')
+    print(str(args_dict) + '\n')
+
+    if args_dict['num_processes'] > 1:
+        torch.multiprocessing.spawn(run_worker, args=(args_dict,), nprocs=args_dict['num_processes'])
+    else:
+        run_worker(0, args_dict)
 
 
 if __name__ == '__main__':
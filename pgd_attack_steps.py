@@ -16,6 +16,12 @@ class AttackStep:
     def random_perturb(self, x, mask):
         raise NotImplementedError
 
+    def project_(self, x):
+        raise NotImplementedError
+
+    def step_(self, x, g):
+        raise NotImplementedError
+
 
 class LinfStep(AttackStep):
     def project(self, x):
@@ -34,6 +40,19 @@ class LinfStep(AttackStep):
         new_x = x + 2*(perturbation-0.5)*self.eps
         return new_x
 
+    # In-place variants of project and step - x and grad are overwritten
+    def project_(self, x):
+        x.sub_(self.orig_x).clamp_(-self.eps, self.eps)
+        return x.add_(self.orig_x).clamp_(0, 1)
+
+    def step_(self, x, grad):
+        return x.add_(grad.sign_(), alpha=self.step_size)
+
+
+# L2 norm of every sample of a batch, shaped for broadcasting over it. The epsilon keeps zero gradients finite.
+def get_sample_norms(x):
+    return x.flatten(1).norm(dim=1).add(1e-12).view(-1, *[1] * (x.dim() - 1))
+
 
 class L2Step(AttackStep):
     def project(self, x):
@@ -43,12 +62,21 @@ class L2Step(AttackStep):
         return new_x
 
     def step(self, x, grad):
-        norm = torch.norm(grad, p=2, keepdim=True).detach()
+        norm = get_sample_norms(grad).detach()
         grad_normed = grad.div(norm)
-        new_x = x + grad_normed*self.eps
+        new_x = x + grad_normed*self.step_size
         return new_x
 
     def random_perturb(self, x, mask):
         perturbation = torch.rand_like(x)*mask
-        new_x = self.project(self.orig_x+perturbation.cuda())
-        return new_x.cpu()
+        new_x = self.project(self.orig_x+perturbation)
+        return new_x
+
+    # In-place variants of project and step - x and grad are overwritten
+    def project_(self, x):
+        x.sub_(self.orig_x).renorm_(p=2, dim=0, maxnorm=self.eps)
+        return x.add_(self.orig_x).clamp_(0, 1)
+
+    def step_(self, x, grad):
+        grad.div_(get_sample_norms(grad)).mul_(self.step_size)
+        return x.add_(grad)
@@ -0,0 +1,170 @@
+import torch
+from pgd import (PARSER_ARGS, ALL_SIMILARITY_COEFFS, Attacker, normalize_args_dict, load_target_model, get_loader,
+                 get_clean_batch, select_attack_batch)
+from model_utils import MODEL_REGISTRY, predict
+from file_utils import get_current_time
+from device_utils import get_execution_context
+import itertools
+import argparse
+import random
+import json
+import copy
+import os
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Keys that determine which target model is built and which images it is evaluated on
+MODEL_KEYS = ['arch', 'checkpoint_location', 'from_robustness', 'device']
+DATASET_KEYS = ['dataset', 'masks', 'batch_size', 'bucket_granularity', 'cache_dataset']
+
+
+def load_grid_file(location):
+    with open(location) as file:
+        if location.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError('PyYAML has to be installed in order to read YAML grid files!')
+            return yaml.safe_load(file)
+        return json.load(file)
+
+
+# Expands the grid into a list of argument dictionaries - the values are given in the same units as the command
+# line arguments of pgd.py and are normalized afterwards. Unknown keys, e.g. misspelled arguments, are rejected, as
+# they would otherwise be ignored silently.
+def get_configurations(grid_dict, save_directory):
+    default_args_dict = {arg_dict['name'][2:]: arg_dict['default'] for arg_dict in PARSER_ARGS}
+    grid = grid_dict.get('grid', {})
+
+    unknown_sections = [key for key in grid_dict.keys() if key not in ['base', 'grid']]
+    if len(unknown_sections) > 0:
+        raise ValueError('Unknown grid file sections: ' + ', '.join(unknown_sections) + '!')
+    unknown_keys = [key for key in list(grid_dict.get('base', {}).keys()) + list(grid.keys())
+                    if key not in default_args_dict]
+    if len(unknown_keys) > 0:
+        raise ValueError('Unknown pgd.py arguments in the grid file: ' + ', '.join(unknown_keys) + '!')
+
+    default_args_dict.update(grid_dict.get('base', {}))
+    keys = list(grid.keys())
+    configurations = []
+
+    for values in itertools.product(*[grid[key] for key in keys]):
+        args_dict = copy.copy(default_args_dict)
+        args_dict.update(dict(zip(keys, values)))
+
+        name = '_'.join(key + '=' + str(value).replace('/', '-') for key, value in zip(keys, values))
+        args_dict['save_file_location'] = os.path.join(save_directory, (name or 'base') + '.pt')
+        configurations.append(normalize_args_dict(args_dict))
+
+    return configurations
+
+
+# Batches of a dataset, together with the labels predicted by a target model, which are loaded lazily and shared by
+# all configurations that use the same model and dataset. Every configuration gets its own copies, so that in-place
+# changes to a batch never leak into the next configurations.
+class CleanBatches:
+    def __init__(self, model, loader, masks, context):
+        self.model = model
+        self.context = context
+        self.loader_iterator = iter(loader)
+        self.masks = masks
+        self.batches = []
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index == len(self.batches):
+                batch = next(self.loader_iterator, None)
+                if batch is None:
+                    return
+                clean_batch = get_clean_batch(self.model, batch, self.masks, self.context)
+                self.batches.append([tensor.cpu() for tensor in clean_batch])
+
+            batch = [self.context.to_device(tensor) for tensor in self.batches[index]]
+            # to_device returns the cached tensor itself when it is already on the device
+            yield index, [tensor.clone() if tensor is cached_tensor else tensor
+                          for tensor, cached_tensor in zip(batch, self.batches[index])]
+            index += 1
+
+
+class SweepRunner:
+    def __init__(self, seed):
+        self.seed = seed
+        self.models = {}
+        self.clean_batches = {}
+
+    def get_model(self, args_dict):
+        model_key = tuple(args_dict[key] for key in MODEL_KEYS)
+        if model_key not in self.models:
+            self.models[model_key] = load_target_model(args_dict, get_execution_context(args_dict))
+        return self.models[model_key]
+
+    def get_clean_batches(self, args_dict, model):
+        key = (tuple(args_dict[key] for key in MODEL_KEYS), tuple(args_dict[key] for key in DATASET_KEYS))
+        if key not in self.clean_batches:
+            self.clean_batches[key] = CleanBatches(model, get_loader(args_dict, self.seed), args_dict['masks'],
+                                                   get_execution_context(args_dict))
+        return self.clean_batches[key]
+
+    def run(self, args_dict):
+        model = self.get_model(args_dict)
+
+        ALL_SIMILARITY_COEFFS.clear()
+        attacker = Attacker(model, args_dict)
+
+        adversarial_examples_list = []
+        predictions_list = []
+
+        for index, clean_batch in self.get_clean_batches(args_dict, model):
+            attack_batch = select_attack_batch(args_dict, *clean_batch)
+            if attack_batch is None:
+                continue
+            image_batch, mask_batch, label_batch, targets = attack_batch
+
+            adversarial_examples = attacker(image_batch, mask_batch, targets, False)
+            adversarial_predictions = predict(model, adversarial_examples)
+
+            adversarial_examples_list.append(adversarial_examples.cpu())
+            predictions_list.append({'original': label_batch.cpu(),
+                                     'adversarial': adversarial_predictions.cpu()})
+
+            if (index + 2) * image_batch.size(0) > args_dict['num_samples']:
+                break
+
+        torch.save({'adversarial_examples': adversarial_examples_list,
+                    'predictions': predictions_list,
+                    'similarity': list(ALL_SIMILARITY_COEFFS),
+                    'args_dict': args_dict},
+                   args_dict['save_file_location'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', type=str, required=True)
+    parser.add_argument('--save_directory', type=str, default='results/pgd_sweeps/' + str(get_current_time()))
+    parser.add_argument('--seed', type=int, default=None)
+    args_dict = vars(parser.parse_args())
+
+    grid_dict = load_grid_file(args_dict['grid'])
+    configurations = get_configurations(grid_dict, args_dict['save_directory'])
+
+    seed = args_dict['seed'] if args_dict['seed'] is not None else random.randrange(2 ** 31)
+    runner = SweepRunner(seed)
+
+    for index, configuration in enumerate(configurations):
+        print('Running configuration ' + str(index + 1) + '/' + str(len(configurations)) + ':')
+        print(str(configuration) + '\n')
+
+        MODEL_REGISTRY.set_memory_budget(configuration['model_cache_memory'] * 1024 ** 2)
+        get_execution_context(configuration).apply_thread_settings()
+        torch.manual_seed(seed)
+        runner.run(configuration)
+
+        print('Results saved to ' + configuration['save_file_location'] + '\n')
+
+    print('Model cache statistics: ' + str(MODEL_REGISTRY.get_stats()) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import torch
+from torch.nn.functional import softmax
+from model_utils import predict
+from collections import OrderedDict
+import functools
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# Target which runs a model in-process
+class LocalTarget:
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, x_batch):
+        with torch.no_grad():
+            return softmax(predict(self.model, x_batch), 1)
+
+
+# Integer types of the same width as the elements of an image, whose bits are hashed
+HASH_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+# Two sets of random odd weights for the fingerprints of images of num_elements elements
+@functools.lru_cache(maxsize=16)
+def get_hash_weights(num_elements, device):
+    generator = torch.Generator()
+    generator.manual_seed(0)
+    weights = torch.randint(-2 ** 62, 2 ** 62, (2, num_elements), generator=generator) * 2 + 1
+    return weights.to(device)
+
+
+# Keys of the images of a batch - two random linear hashes of the bits of every image modulo 2^64, computed on the
+# device of the batch, so only two integers per image are copied to the host. Two different float32 images get the
+# same key with a probability below 2^-64.
+def get_image_keys(x_batch):
+    bits = x_batch.detach().contiguous().view(x_batch.size(0), -1)
+    bits = bits.view(HASH_DTYPES[bits.element_size()]).to(torch.int64)
+    fingerprints = torch.stack([(bits * weights).sum(dim=1)
+                                for weights in get_hash_weights(bits.size(1), bits.device)], dim=1)
+    return [tuple(key) for key in fingerprints.tolist()]
+
+
+# Black-box access to a target model, which returns the softmax probabilities of a batch of images. Every image
+# sent to the model is one query. The responses are memoized in a bounded LRU cache keyed by a fingerprint of the
+# bits of the image, so bit-identical images, e.g. candidates which are unchanged after clamping, are answered
+# without a query. A cache_size of 0 disables the cache and the hashing. The target is either a model, which is run
+# in-process, or any callable which returns the probabilities of a batch, e.g. a remote_target.RemoteTarget.
+class QueryOracle:
+    def __init__(self, model, query_budget=None, cache_size=1024):
+        self.target = LocalTarget(model) if isinstance(model, torch.nn.Module) else model
+        self.query_budget = query_budget
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.num_queries = 0
+        self.cache_hits = 0
+
+    # The counters and the cache are per image
+    def reset(self):
+        self.cache.clear()
+        self.num_queries = 0
+        self.cache_hits = 0
+
+    def get_remaining_queries(self):
+        if self.query_budget is None:
+            return None
+        return self.query_budget - self.num_queries
+
+    def __call__(self, x_batch):
+        return query_oracles([self], [x_batch])[0]
+
+    # Looks the images up in the cache and returns their keys, the responses found and the indices of the images
+    # which have to be sent to the model. A batch which does not fit in the budget is not sent at all.
+    def lookup(self, x_batch):
+        if self.cache_size == 0:
+            keys, responses, missing_indices = None, None, list(range(x_batch.size(0)))
+        else:
+            keys = get_image_keys(x_batch)
+            responses = {}
+            missing_indices = []
+            for index, key in enumerate(keys):
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    responses[key] = self.cache[key]
+                elif key not in responses:
+                    responses[key] = None
+                    missing_indices.append(index)
+
+        if self.query_budget is not None and self.num_queries + len(missing_indices) > self.query_budget:
+            raise QueryBudgetExceeded
+
+        return keys, responses, missing_indices
+
+    # Stores the probabilities of the missing images and returns the responses of the whole batch
+    def store(self, keys, responses, missing_indices, probabilities):
+        if keys is None:
+            self.num_queries += len(missing_indices)
+            return probabilities
+
+        for index, response in zip(missing_indices, probabilities):
+            responses[keys[index]] = response
+            self.cache[keys[index]] = response
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        self.num_queries += len(missing_indices)
+        self.cache_hits += len(keys) - len(missing_indices)
+        return torch.stack([responses[key] for key in keys])
+
+    def get_stats(self):
+        return {'num_queries': self.num_queries,
+                'cache_hits': self.cache_hits,
+                'query_budget': self.query_budget}
+
+
+# Answers the queries of several oracles of the same target with a single forward pass, e.g. those of several images
+# attacked concurrently. Every oracle keeps its own counters, budget and cache.
+def query_oracles(oracles, x_batches):
+    lookups = [oracle.lookup(x_batch) for oracle, x_batch in zip(oracles, x_batches)]
+    num_missing = [len(missing_indices) for _, _, missing_indices in lookups]
+
+    probabilities = [[] for _ in oracles]
+    if sum(num_missing) > 0:
+        missing_images = torch.cat([x_batch[missing_indices]
+                                    for x_batch, (_, _, missing_indices) in zip(x_batches, lookups)])
+        probabilities = torch.split(oracles[0].target(missing_images), num_missing)
+
+    return [oracle.store(*lookup, oracle_probabilities)
+            for oracle, lookup, oracle_probabilities in zip(oracles, lookups, probabilities)]
@@ -0,0 +1,321 @@
+import torch
+from torch.nn.functional import softmax
+from model_utils import ARCHS_LIST, get_model, predict
+from device_utils import ExecutionContext
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+from collections import deque
+import numpy as np
+import threading
+import argparse
+import asyncio
+import struct
+import json
+
+# Every message is a 4 byte header length, a JSON header with the shape of a float32 tensor and the tensor data
+HEADER_LENGTH_FORMAT = '!I'
+
+
+# Error raised by the server while answering a request, which only fails that request
+class TargetError(Exception):
+    pass
+
+
+async def read_tensor(reader):
+    header_length, = struct.unpack(HEADER_LENGTH_FORMAT, await reader.readexactly(4))
+    header = json.loads((await reader.readexactly(header_length)).decode())
+    if 'error' in header:
+        raise TargetError(header['error'])
+
+    data = await reader.readexactly(4 * int(np.prod(header['shape'])))
+    return torch.from_numpy(np.frombuffer(data, dtype=np.float32).reshape(header['shape']).copy())
+
+
+def write_tensor(writer, tensor):
+    tensor = tensor.detach().to(device='cpu', dtype=torch.float).contiguous()
+    header = json.dumps({'shape': list(tensor.size())}).encode()
+    writer.write(struct.pack(HEADER_LENGTH_FORMAT, len(header)) + header + tensor.numpy().tobytes())
+
+
+def write_error(writer, error):
+    header = json.dumps({'error': str(error)}).encode()
+    writer.write(struct.pack(HEADER_LENGTH_FORMAT, len(header)) + header)
+
+
+async def open_connection(address):
+    if address.startswith('unix:'):
+        return await asyncio.open_unix_connection(address[len('unix:'):])
+    host, port = address.rsplit(':', 1)
+    return await asyncio.open_connection(host, int(port))
+
+
+# Stand-in for a network inference endpoint, which returns the softmax probabilities of the batches it is sent. The
+# requests of a connection can be pipelined - they are answered concurrently and the responses are sent in order.
+# The injected latency of a request is latency + latency_per_image * batch size milliseconds, and the latencies of
+# concurrent requests overlap, like network latencies do.
+class TargetServer:
+    def __init__(self, model, context, latency=0.0, latency_per_image=0.0):
+        self.model = model
+        self.context = context
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        # A single thread runs the model, so that the event loop is never blocked by a forward pass
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def get_probabilities(self, x_batch):
+        with torch.no_grad():
+            return softmax(predict(self.model, self.context.to_device(x_batch)), 1).cpu()
+
+    async def answer(self, x_batch):
+        probabilities = await asyncio.get_event_loop().run_in_executor(self.executor, self.get_probabilities, x_batch)
+        await asyncio.sleep((self.latency + self.latency_per_image * x_batch.size(0)) / 1000.0)
+        return probabilities
+
+    async def send_responses(self, writer, responses):
+        while True:
+            response = await responses.get()
+            if response is None:
+                return
+
+            try:
+                write_tensor(writer, await response)
+            except Exception as error:
+                write_error(writer, error)
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        responses = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send_responses(writer, responses))
+
+        try:
+            while True:
+                x_batch = await read_tensor(reader)
+                await responses.put(asyncio.ensure_future(self.answer(x_batch)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        await responses.put(None)
+        await sender
+        writer.close()
+
+    async def serve(self, address):
+        if address.startswith('unix:'):
+            server = await asyncio.start_unix_server(self.handle_connection, address[len('unix:'):])
+        else:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle_connection, host, int(port))
+
+        async with server:
+            await server.serve_forever()
+
+
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Futures of the requests sent on the connection, in order, with the sizes of the queries they coalesce
+        self.pending = deque()
+        self.closed = False
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    async def receive(self):
+        try:
+            while True:
+                try:
+                    probabilities = await read_tensor(self.reader)
+                except TargetError as error:
+                    future, _ = self.pending.popleft()
+                    future.set_exception(error)
+                    continue
+
+                future, sizes = self.pending.popleft()
+                future.set_result(torch.split(probabilities, sizes))
+        except Exception as error:
+            self.fail(ConnectionError('The connection to the target was lost: ' + str(error)))
+
+    # Nothing answers the requests in flight once the connection is lost, so they fail and no more are sent
+    def fail(self, error):
+        self.closed = True
+        while len(self.pending) > 0:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    def send(self, x_batch, sizes):
+        if self.closed:
+            raise ConnectionError('The connection to the target is closed!')
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((future, sizes))
+        write_tensor(self.writer, x_batch)
+        return future
+
+    def close(self):
+        self.closed = True
+        self.receiver.cancel()
+        self.writer.close()
+
+
+# Client of a TargetServer. Concurrent queries are coalesced into batched requests of up to max_batch_size images,
+# waiting at most max_delay seconds for more queries to arrive. A batch is sent without waiting once every caller with
+# an unanswered query is in it or in a request in flight, e.g. always for a single caller. The requests are pipelined
+# over num_connections kept-alive connections - every request goes to the open connection with the fewest requests in
+# flight, and lost connections are reopened before the next request.
+class AsyncQueryClient:
+    def __init__(self, address, num_connections=4, max_batch_size=256, max_delay=0.002):
+        self.address = address
+        self.num_connections = num_connections
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.connections = []
+        self.queries = None
+        self.batcher = None
+        # Callers waiting for an answer, and the queries of requests in flight
+        self.num_callers = 0
+        self.num_sent_queries = 0
+        self.stats = {'queries': 0, 'requests': 0}
+
+    async def connect(self):
+        for _ in range(self.num_connections):
+            reader, writer = await open_connection(self.address)
+            self.connections.append(Connection(reader, writer))
+        self.queries = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.coalesce_queries())
+
+    async def query(self, x_batch):
+        future = asyncio.get_event_loop().create_future()
+        self.num_callers += 1
+        try:
+            await self.queries.put((x_batch.detach().cpu(), future))
+            self.stats['queries'] += 1
+            return await future
+        finally:
+            self.num_callers -= 1
+
+    async def get_queries(self):
+        queries = [await self.queries.get()]
+        num_images = queries[0][0].size(0)
+        deadline = asyncio.get_event_loop().time() + self.max_delay
+
+        while num_images < self.max_batch_size:
+            if self.queries.empty():
+                if len(queries) + self.num_sent_queries >= self.num_callers:
+                    break
+                timeout = deadline - asyncio.get_event_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    query = await asyncio.wait_for(self.queries.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                query = self.queries.get_nowait()
+            queries.append(query)
+            num_images += query[0].size(0)
+
+        return queries
+
+    async def coalesce_queries(self):
+        while True:
+            queries = await self.get_queries()
+            x_batches, futures = zip(*queries)
+
+            try:
+                connection = await self.get_connection()
+                request = connection.send(torch.cat(x_batches), [x_batch.size(0) for x_batch in x_batches])
+            except ConnectionError as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            self.stats['requests'] += 1
+            self.num_sent_queries += len(futures)
+            request.add_done_callback(lambda request, futures=futures: self.resolve(request, futures))
+
+    async def get_connection(self):
+        for index, connection in enumerate(self.connections):
+            if connection.closed:
+                try:
+                    reader, writer = await open_connection(self.address)
+                except OSError:
+                    continue
+                connection.close()
+                self.connections[index] = Connection(reader, writer)
+
+        open_connections = [connection for connection in self.connections if not connection.closed]
+        if len(open_connections) == 0:
+            raise ConnectionError('No connection to the target at ' + self.address + '!')
+        return min(open_connections, key=lambda c: len(c.pending))
+
+    def resolve(self, request, futures):
+        self.num_sent_queries -= len(futures)
+        for index, future in enumerate(futures):
+            # The caller may have stopped waiting for the query, e.g. after a timeout
+            if future.done():
+                continue
+
+            if request.cancelled():
+                future.cancel()
+            elif request.exception() is not None:
+                future.set_exception(request.exception())
+            else:
+                future.set_result(request.result()[index])
+
+    async def close(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+        for connection in self.connections:
+            connection.close()
+
+
+# Synchronous target for a QueryOracle. The client runs on an event loop in a background thread, so that queries
+# made concurrently from several threads are coalesced into batched requests. A call which is not answered within
+# timeout seconds raises a TimeoutError instead of blocking the attack.
+class RemoteTarget:
+    def __init__(self, address, num_connections=4, max_batch_size=256, max_delay=0.002, timeout=60.0):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.client = AsyncQueryClient(address, num_connections, max_batch_size, max_delay)
+        self.run(self.client.connect())
+
+    def run(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError('The target did not answer within ' + str(self.timeout) + ' seconds!')
+
+    def __call__(self, x_batch):
+        return self.run(self.client.query(x_batch)).to(device=x_batch.device, dtype=x_batch.dtype)
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch', type=str, choices=ARCHS_LIST, default='resnet50')
+    parser.add_argument('--address', type=str, default='127.0.0.1:8765')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency_per_image', type=float, default=0.0)
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args_dict = vars(parser.parse_args())
+
+    context = ExecutionContext(device=args_dict['device'], num_threads=args_dict['num_threads'])
+    context.apply_thread_settings()
+    model = context.prepare_model(get_model(args_dict['arch'], parameters='standard', freeze=True)).eval()
+    server = TargetServer(model, context, args_dict['latency'], args_dict['latency_per_image'])
+
+    print('Serving ' + args_dict['arch'] + ' on ' + args_dict['address'] + '...')
+    asyncio.get_event_loop().run_until_complete(server.serve(args_dict['address']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import torch
+import pytest
+from device_utils import ExecutionContext
+from blackbox import run_simba_pool
+
+
+def get_args_dict(pool_size, num_iterations):
+    return {'pool_size': pool_size,
+            'num_iterations': num_iterations,
+            'simba_batch_size': 4,
+            'simba_acceptance': 'greedy',
+            'basis': 'pixel',
+            'conv': False,
+            'eps': 0.2,
+            'early_stopping': False,
+            'query_budget': None,
+            'query_cache_size': 1024}
+
+
+# Every image of the dataset gets a result, whether or not the pool size divides the dataset size, including when
+# all images in flight finish in the same round
+@pytest.mark.parametrize('pool_size', [1, 2, 3, 4, 5, 8])
+@pytest.mark.parametrize('num_iterations', [1, 3])
+def test_simba_pool_attacks_the_whole_dataset(pool_size, num_iterations):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * 4 * 4, 10)).eval()
+    dataset = [torch.rand(3, 4, 4) for _ in range(5)]
+    context = ExecutionContext(device='cpu', channels_last=False)
+
+    adversarial_examples, predictions, queries = run_simba_pool(model, model, dataset, context,
+                                                                get_args_dict(pool_size, num_iterations))
+
+    assert len(adversarial_examples) == len(dataset)
+    assert len(predictions) == len(dataset)
+    assert len(queries) == len(dataset)
+    assert all(stats['iterations'] == num_iterations for stats in queries)
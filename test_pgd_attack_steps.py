@@ -0,0 +1,22 @@
+import torch
+from pgd_attack_steps import L2Step
+
+
+def test_l2_step_norm_is_step_size_per_sample():
+    # A batch of replicated restarts, with gradients of very different scales
+    x = torch.rand(6, 3, 8, 8)
+    grad = torch.randn(6, 3, 8, 8) * torch.tensor([1e-3, 1e-1, 1.0, 10.0, 100.0, 1.0]).view(-1, 1, 1, 1)
+    step = L2Step(x, eps=2.0, step_size=0.5)
+
+    step_norms = (step.step(x, grad) - x).flatten(1).norm(dim=1)
+    assert torch.allclose(step_norms, torch.full([6], 0.5), atol=1e-5)
+
+    x_in_place = x.clone()
+    step_norms = (step.step_(x_in_place, grad.clone()) - x).flatten(1).norm(dim=1)
+    assert torch.allclose(step_norms, torch.full([6], 0.5), atol=1e-5)
+
+
+def test_l2_step_of_zero_gradient_is_finite():
+    x = torch.rand(2, 3, 8, 8)
+    step = L2Step(x, eps=2.0, step_size=0.5)
+    assert torch.equal(step.step(x, torch.zeros_like(x)), x)
@@ -3,7 +3,9 @@ from torch.nn import functional as F
 import torchvision
 from PIL import Image
 from dataset_utils import plot
-import math
+from device_utils import get_default_device
+from collections import OrderedDict
+import functools
 import random
 import sys
 import argparse
@@ -17,6 +19,8 @@ def get_transformation_bounds_dict():
         'blur_kernel_length': [0, 8],
         'translation': [-10.0, 10.0],
         'rotation': [-10, 10],
+        'scale': [0.9, 1.1],
+        'shear': [-0.1, 0.1],
     }
 
     return bounds_dict
@@ -33,19 +37,28 @@ def get_transformation(transformation_type):
         return Translation()
     elif transformation_type == 'rotation':
         return Rotation()
+    elif transformation_type == 'scale':
+        return Scale()
+    elif transformation_type == 'shear':
+        return Shear()
     else:
         raise ValueError
 
 
+RANDOM_TRANSFORMATION_TYPES = ['rotation', 'noise', 'light', 'translation']
+
+
 def get_random_transformation():
-    transformation_types_list = ['rotation', 'noise', 'light', 'translation']
-    transformation_type = random.choice(transformation_types_list)
+    transformation_type = random.choice(RANDOM_TRANSFORMATION_TYPES)
 
     t = get_transformation(transformation_type)
     return t
 
 
 class Transformation:
+    # Parameter value which leaves the image unchanged
+    identity_parameter = 0.0
+
     def __init__(self, transformation_type):
         if transformation_type not in get_transformation_bounds_dict():
             sys.exit('Invalid transformation type!')
@@ -55,30 +68,29 @@ class Transformation:
         self.parameters = None
         self.algorithm = 1
 
+    # The whole batch is transformed in a single vectorized call, using one row of the parameter tensor per sample.
+    # Parameters set explicitly are reused on every call, otherwise new random ones are drawn each time.
     def __call__(self, x):
         if len(x.size()) != 4:
             x = x.unsqueeze(0)
 
-        if self.parameters is None:
-            self.parameters = [self.get_random_parameters() for i in range(x.size(0))]
-
-        x_chunks = torch.chunk(x, x.size(0), dim=0)
-        x_chunks_transformed = []
+        return self.transform(x, self.get_parameters(x.size(0), x.device))
 
-        for index in range(len(x)):
-            x_chunks_transformed.append(self.transform(x_chunks[index], index))
-        x = torch.cat(x_chunks_transformed, 0)
+    def get_parameters(self, batch_size, device):
+        if self.parameters is None:
+            return self.get_random_parameters(batch_size, device)
 
-        self.parameters = None
-        return x
+        parameters = torch.tensor(self.parameters, dtype=torch.float, device=device)
+        return parameters.expand(batch_size, *parameters.size()[1:])
 
-    def get_random_parameters(self):
-        return random.uniform(self.lower_bound, self.upper_bound)
+    def get_random_parameters(self, batch_size, device, generator=None):
+        random_values = torch.rand(batch_size, device=device, generator=generator)
+        return self.lower_bound + (self.upper_bound - self.lower_bound) * random_values
 
     def set_algorithm(self, algorithm):
         self.algorithm = algorithm
 
-    def transform(self, x, index):
+    def transform(self, x, parameters):
         raise NotImplementedError
 
 
@@ -87,10 +99,8 @@ class LightAdjustment(Transformation):
         self.transformation_type = 'light'
         super(LightAdjustment, self).__init__(transformation_type=self.transformation_type)
 
-    def transform(self, x, index):
-        light = torch.cuda.FloatTensor().new_full(x.size(), self.parameters[index])
-        x = torch.add(x, light)
-        return x
+    def transform(self, x, parameters):
+        return x + parameters.view(-1, 1, 1, 1)
 
 
 class Noise(Transformation):
@@ -98,18 +108,53 @@ class Noise(Transformation):
         self.transformation_type = 'noise'
         super(Noise, self).__init__(transformation_type=self.transformation_type)
 
-    def transform(self, x, index):
-        noise = torch.normal(mean=0.0, std=self.parameters[index], size=x.size(), device=torch.device('cuda'))
-        x = torch.add(x, noise).float()
-        return x
+    def transform(self, x, parameters):
+        noise = torch.randn_like(x) * parameters.view(-1, 1, 1, 1)
+        return torch.add(x, noise).float()
+
+
+# Fuses light adjustments and Gaussian noise into a single elementwise pass - the offsets are added up and so are the
+# variances of the noise
+def apply_photometric_transformations(x, transformations):
+    offset = torch.zeros(x.size(0), device=x.device)
+    noise_variance = torch.zeros(x.size(0), device=x.device)
+
+    for transformation in transformations:
+        parameters = transformation.get_parameters(x.size(0), x.device)
+        if isinstance(transformation, LightAdjustment):
+            offset = offset + parameters
+        else:
+            noise_variance = noise_variance + parameters ** 2
+
+    noise_std = noise_variance.sqrt().view(-1, 1, 1, 1)
+    return torch.addcmul(x + offset.view(-1, 1, 1, 1), torch.randn_like(x), noise_std)
+
+
+# Normalized 1D Gaussian kernel - a kernel of length k samples the Gaussian at k evenly spaced points in
+# [-sigma, sigma], and the outer product of a kernel with itself is the 2D blur kernel. Only kernels of fixed
+# parameters are built here, so the cache hits on every call after the first one.
+@functools.lru_cache(maxsize=256)
+def gaussian_kernel_1d(kernel_length, sigma, dtype, device):
+    x = torch.linspace(-sigma, sigma, kernel_length, dtype=torch.float64)
+    kernel = torch.exp(-x ** 2 / 2.0)
+    return (kernel / kernel.sum()).to(dtype=dtype, device=device)
+
+
+# The kernels of the given odd lengths and sigmas, one row per sample, built in a single vectorized call on the
+# device of the sigmas. Every kernel is centered and zero-padded to the odd kernel_length, which bounds the lengths,
+# so that no value has to be read back to the host.
+def get_gaussian_kernels(kernel_lengths, sigmas, kernel_length, dtype):
+    kernel_lengths = kernel_lengths.to(dtype=dtype, device=sigmas.device).view(-1, 1)
+    positions = torch.arange(kernel_length, dtype=dtype, device=sigmas.device) - (kernel_length - kernel_lengths) / 2
+    x = sigmas.to(dtype).view(-1, 1) * (2 * positions / (kernel_lengths - 1).clamp(min=1) - 1)
 
+    kernels = torch.exp(-x ** 2 / 2.0) * ((positions >= 0) & (positions < kernel_lengths)).to(dtype)
+    return kernels / kernels.sum(dim=1, keepdim=True)
 
-def gaussian_kernel(kernel_length, sigma=1.):
-    x = torch.linspace(-sigma, sigma, kernel_length).cuda()
-    kernel_1d = torch.exp(-x ** 2 / 2.0) / torch.sqrt(torch.Tensor([2 * math.pi]).cuda())
-    kernel_raw = torch.ger(kernel_1d, kernel_1d)
-    kernel = kernel_raw / kernel_raw.sum()
-    return kernel
+
+# Length of the kernels of a batch, padded to the longest odd length a kernel can have
+def get_padded_kernel_length(max_kernel_length):
+    return max_kernel_length + (1 - max_kernel_length % 2)
 
 
 class Blur(Transformation):
@@ -117,75 +162,293 @@ class Blur(Transformation):
         self.transformation_type = 'blur'
         super(Blur, self).__init__(transformation_type=self.transformation_type)
 
-    def get_random_parameters(self):
-        return (0,
-                random.uniform(self.lower_bound, self.upper_bound))
+    def get_random_parameters(self, batch_size, device, generator=None):
+        random_values = torch.rand(batch_size, device=device, generator=generator)
+        sigmas = self.lower_bound + (self.upper_bound - self.lower_bound) * random_values
+        return torch.stack([torch.zeros_like(sigmas), sigmas], dim=1)
 
-    def transform(self, x, index):
-        kernel_length, sigma = self.parameters[index]
+    def transform(self, x, parameters):
         max_kernel_length = min(x.size(2), x.size(3))//8
 
-        if kernel_length == 0 or kernel_length >= max_kernel_length:
-            kernel_length = random.randint(1,  max_kernel_length)
+        # A single set of fixed parameters with a valid kernel length gives the same kernel on every call
+        if self.parameters is not None and len(self.parameters) == 1:
+            kernel_length, sigma = round(self.parameters[0][0]), float(self.parameters[0][1])
+            if 0 < kernel_length < max_kernel_length:
+                kernel_length = kernel_length + (1 - kernel_length % 2)
+                return separable_blur(x, gaussian_kernel_1d(kernel_length, sigma, x.dtype, x.device))
 
-        kernel = gaussian_kernel(kernel_length, sigma)
-        kernel = kernel.view(1, 1, kernel_length, kernel_length)
-        kernel = kernel.repeat(3, 1, 1, 1)
+        kernel_lengths, sigmas = parameters[:, 0].round(), parameters[:, 1]
+
+        # Missing or too long kernel lengths are replaced by random ones, and even lengths are made odd, so that
+        # every kernel can be centered
+        random_kernel_lengths = torch.randint_like(kernel_lengths, 1, max_kernel_length + 1)
+        invalid_kernel_lengths = (kernel_lengths == 0) | (kernel_lengths >= max_kernel_length)
+        kernel_lengths = torch.where(invalid_kernel_lengths, random_kernel_lengths, kernel_lengths)
+        kernel_lengths = kernel_lengths + (1 - kernel_lengths % 2)
+
+        kernels = get_gaussian_kernels(kernel_lengths, sigmas, get_padded_kernel_length(max_kernel_length), x.dtype)
+        return separable_blur(x, kernels)
+
+
+# Convolves x with a single 1D kernel shared by all samples, or with one kernel per sample (a 2D tensor)
+def separable_blur(x, kernels):
+    batch_size, channels, height, width = x.size()
+    kernel_length = kernels.size(-1)
+
+    if kernels.dim() == 1:
+        # All samples share the kernel, so every channel of every sample is convolved with the same filter
+        x = x.reshape(batch_size * channels, 1, height, width)
+        groups = 1
+    else:
+        # Otherwise every (sample, channel) pair is a separate group
+        kernels = kernels.repeat_interleave(channels, dim=0)
+        x = x.reshape(1, batch_size * channels, height, width)
+        groups = batch_size * channels
+
+    # The 2D Gaussian is separable - a vertical and a horizontal pass cost O(2k) per pixel instead of O(k^2)
+    padding = kernel_length // 2
+    x = F.conv2d(input=x, weight=kernels.view(-1, 1, kernel_length, 1), groups=groups, padding=(padding, 0))
+    x = F.conv2d(input=x, weight=kernels.view(-1, 1, 1, kernel_length), groups=groups, padding=(0, padding))
+    return x.view(batch_size, channels, height, width)
 
-        x = F.conv2d(input=x, weight=kernel, groups=x.size(1), padding=kernel_length // 2)
-        return x
 
+# Geometric transformations are applied by sampling the image with an affine grid - transformation_matrix returns
+# the per-sample 2x3 matrices which map output to input coordinates
+class GeometricTransformation(Transformation):
+    mode = 'bilinear'
+
+    def transformation_matrix(self, parameters, size):
+        raise NotImplementedError
+
+    def transform(self, x, parameters):
+        matrix = self.transformation_matrix(parameters, x.size()).to(x.dtype)
+        grid = F.affine_grid(matrix, x.size(), align_corners=False)
+        return F.grid_sample(x, grid, mode=self.mode, align_corners=False)
+
+
+class Translation(GeometricTransformation):
+    mode = 'nearest'
 
-class Translation(Transformation):
     def __init__(self):
         self.transformation_type = 'translation'
         super(Translation, self).__init__(transformation_type=self.transformation_type)
 
-    def get_random_parameters(self):
-        return (random.randint(self.lower_bound, self.upper_bound),
-                random.randint(self.lower_bound, self.upper_bound))
+    def get_random_parameters(self, batch_size, device, generator=None):
+        return torch.randint(int(self.lower_bound), int(self.upper_bound) + 1, (batch_size, 2),
+                             device=device, generator=generator).float()
 
-    def transform(self, x, index):
-        translation = self.parameters[index]
-        content_mask = torch.ones_like(x)[0]
+    # Shifts by whole pixels - rows by the first parameter and columns by the second one, filling with zeros
+    def transformation_matrix(self, parameters, size):
+        matrix = torch.zeros(parameters.size(0), 2, 3, device=parameters.device)
+        matrix[:, 0, 0] = 1
+        matrix[:, 1, 1] = 1
+        matrix[:, 0, 2] = -2 * parameters[:, 1] / size[3]
+        matrix[:, 1, 2] = -2 * parameters[:, 0] / size[2]
+        return matrix
 
-        x = torch.roll(x, shifts=translation, dims=(2, 3))
 
-        for j in range(3):
-            if translation[0] < 0:
-                content_mask[j, translation[0]:content_mask.size(1)] = 0
-            else:
-                content_mask[j, 0: translation[0]] = 0
-            if translation[1] < 0:
-                for i in range(-1, translation[1] - 1, -1):
-                    content_mask[j, :, i] = 0
-            else:
-                for i in range(translation[1]):
-                    content_mask[j, :, i] = 0
+class Rotation(GeometricTransformation):
+    def __init__(self):
+        self.transformation_type = 'rotation'
+        super(Rotation, self).__init__(transformation_type=self.transformation_type)
 
-        x = x * content_mask
-        return x
+    def transformation_matrix(self, parameters, size):
+        sin = torch.sin(torch.deg2rad(parameters))
+        cos = torch.cos(torch.deg2rad(parameters / 2))
+
+        matrix = torch.zeros(parameters.size(0), 2, 3, device=parameters.device)
+        matrix[:, 0, 0] = cos
+        matrix[:, 0, 1] = sin
+        matrix[:, 1, 0] = sin
+        matrix[:, 1, 1] = cos
+        return matrix
 
 
-class Rotation(Transformation):
+class Scale(GeometricTransformation):
+    identity_parameter = 1.0
+
     def __init__(self):
-        self.transformation_type = 'rotation'
-        super(Rotation, self).__init__(transformation_type=self.transformation_type)
+        self.transformation_type = 'scale'
+        super(Scale, self).__init__(transformation_type=self.transformation_type)
+
+    def transformation_matrix(self, parameters, size):
+        matrix = torch.zeros(parameters.size(0), 2, 3, device=parameters.device)
+        matrix[:, 0, 0] = 1 / parameters
+        matrix[:, 1, 1] = 1 / parameters
+        return matrix
+
+
+class Shear(GeometricTransformation):
+    def __init__(self):
+        self.transformation_type = 'shear'
+        super(Shear, self).__init__(transformation_type=self.transformation_type)
+
+    def transformation_matrix(self, parameters, size):
+        matrix = torch.zeros(parameters.size(0), 2, 3, device=parameters.device)
+        matrix[:, 0, 0] = 1
+        matrix[:, 0, 1] = parameters
+        matrix[:, 1, 1] = 1
+        return matrix
+
+
+def to_homogeneous(matrix):
+    last_row = torch.tensor([0, 0, 1], dtype=matrix.dtype, device=matrix.device).expand(matrix.size(0), 1, 3)
+    return torch.cat([matrix, last_row], dim=1)
+
+
+# Applies several transformations at the cost of a single warp - the matrices of all geometric transformations are
+# multiplied into one affine matrix per sample, the light adjustments and the noise are fused into one elementwise
+# pass and any other transformation (blur) is applied afterwards. This order is fixed - the given order only decides
+# how the geometric transformations are composed and in which order the other ones are applied.
+class ComposedTransformation:
+    def __init__(self, transformation_types):
+        self.transformations = [get_transformation(transformation_type)
+                                for transformation_type in transformation_types]
+
+    def __call__(self, x):
+        if len(x.size()) != 4:
+            x = x.unsqueeze(0)
+
+        geometric_transformations = [t for t in self.transformations if isinstance(t, GeometricTransformation)]
+        photometric_transformations = [t for t in self.transformations if isinstance(t, (LightAdjustment, Noise))]
+        other_transformations = [t for t in self.transformations
+                                 if t not in geometric_transformations and t not in photometric_transformations]
+
+        if len(geometric_transformations) > 0:
+            # The matrices map output to input coordinates, so applying A and then B samples with A @ B
+            matrix = torch.eye(3, device=x.device).expand(x.size(0), 3, 3)
+            for transformation in geometric_transformations:
+                parameters = transformation.get_parameters(x.size(0), x.device)
+                matrix = matrix @ to_homogeneous(transformation.transformation_matrix(parameters, x.size()))
+
+            grid = F.affine_grid(matrix[:, :2].to(x.dtype), x.size(), align_corners=False)
+            x = F.grid_sample(x, grid, align_corners=False)
+
+        if len(photometric_transformations) > 0:
+            x = apply_photometric_transformations(x, photometric_transformations)
+
+        for transformation in other_transformations:
+            x = transformation(x)
+
+        return x
+
 
-    def transform(self, x, index):
-        x_t = x.clone()
+# Fixed, seeded set of transformations for EOT. The composed sampling grid, the photometric parameters and the blur
+# kernels of every entry are computed once per input size and device, so applying the bank only gathers them and
+# warps the batch. Every sample gets a random entry, drawn with the generator of the bank, which makes runs
+# reproducible. Without transformation types, every entry applies a single random one of
+# RANDOM_TRANSFORMATION_TYPES, like get_random_transformation.
+class TransformationBank:
+    # The grids of a size take size x H x W x 2 values, so only those of the most recently used input sizes are kept,
+    # e.g. for the varying image sizes of a bucketed loader
+    cache_size = 4
+
+    def __init__(self, transformation_types=None, size=100, seed=0):
+        exclusive = transformation_types is None
+        if exclusive:
+            transformation_types = RANDOM_TRANSFORMATION_TYPES
+
+        self.transformations = [get_transformation(transformation_type)
+                                for transformation_type in transformation_types]
+        self.size = size
+        self.seed = seed
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self.device_generators = {}
+        self.parameters = [transformation.get_random_parameters(size, 'cpu', self.generator)
+                           for transformation in self.transformations]
+        # Blur kernel lengths depend on the image size, so only their position in the valid range is drawn here
+        self.kernel_length_fractions = [torch.rand(size, generator=self.generator)
+                                        for transformation in self.transformations
+                                        if isinstance(transformation, Blur)]
+
+        if exclusive:
+            chosen_transformations = torch.randint(len(self.transformations), (size,), generator=self.generator)
+            for index, (transformation, parameters) in enumerate(zip(self.transformations, self.parameters)):
+                parameters[chosen_transformations != index] = transformation.identity_parameter
+
+        self.cache = OrderedDict()
+
+    def __call__(self, x, indices=None):
+        if len(x.size()) != 4:
+            x = x.unsqueeze(0)
+
+        if indices is None:
+            indices = torch.randint(self.size, (x.size(0),), generator=self.generator)
+        indices = indices.to(x.device)
+        cached = self.get_cached(x.size(), x.dtype, x.device)
 
-        sin = torch.sin(torch.deg2rad(torch.cuda.FloatTensor([self.parameters[index]])))
-        cos = torch.cos(torch.deg2rad(torch.cuda.FloatTensor([self.parameters[index] / 2])))
-        rotation_matrix = torch.tensor([[cos, sin, 0],
-                                        [sin, cos, 0]]).cuda().repeat(x_t.shape[0], 1, 1)
+        if cached['grid'] is not None:
+            x = F.grid_sample(x, cached['grid'][indices], align_corners=False)
 
-        grid = F.affine_grid(rotation_matrix, x_t.size(), align_corners=False)
+        if cached['offset'] is not None:
+            noise = torch.randn(x.size(), dtype=x.dtype, device=x.device, generator=self.get_generator(x.device))
+            x = torch.addcmul(x + cached['offset'][indices].view(-1, 1, 1, 1),
+                              noise,
+                              cached['noise_std'][indices].view(-1, 1, 1, 1))
+
+        for kernels in cached['kernels']:
+            x = separable_blur(x, kernels[indices])
 
-        x_t = F.grid_sample(x_t, grid, align_corners=False)
-        x = x_t
         return x
 
+    # The noise is drawn on the device of the input, so other devices get their own generator, seeded like the bank
+    def get_generator(self, device):
+        if device.type == 'cpu':
+            return self.generator
+        if device not in self.device_generators:
+            self.device_generators[device] = torch.Generator(device=device)
+            self.device_generators[device].manual_seed(self.seed)
+        return self.device_generators[device]
+
+    def get_cached(self, size, dtype, device):
+        key = (size[2], size[3], dtype, device)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.cache[key] = self.precompute(size, dtype, device)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return self.cache[key]
+
+    # Same order as ComposedTransformation - one warp, then the photometric transformations, then the blurs
+    def precompute(self, size, dtype, device):
+        cached = {'grid': None, 'offset': None, 'noise_std': None, 'kernels': []}
+        geometric, photometric = False, False
+        matrix = torch.eye(3).expand(self.size, 3, 3)
+        offset = torch.zeros(self.size)
+        noise_variance = torch.zeros(self.size)
+        kernel_length_fractions = iter(self.kernel_length_fractions)
+
+        for transformation, parameters in zip(self.transformations, self.parameters):
+            if isinstance(transformation, GeometricTransformation):
+                matrix = matrix @ to_homogeneous(transformation.transformation_matrix(parameters, size))
+                geometric = True
+            elif isinstance(transformation, LightAdjustment):
+                offset = offset + parameters
+                photometric = True
+            elif isinstance(transformation, Noise):
+                noise_variance = noise_variance + parameters ** 2
+                photometric = True
+            else:
+                # Same kernel lengths as Blur draws for unset ones
+                max_kernel_length = min(size[2], size[3]) // 8
+                kernel_lengths = (next(kernel_length_fractions) * max_kernel_length).long() + 1
+                kernel_lengths = kernel_lengths + (1 - kernel_lengths % 2)
+                cached['kernels'].append(get_gaussian_kernels(kernel_lengths, parameters[:, 1].to(device),
+                                                              get_padded_kernel_length(max_kernel_length), dtype))
+
+        if geometric:
+            grid_size = [self.size, 1, size[2], size[3]]
+            cached['grid'] = F.affine_grid(matrix[:, :2], grid_size, align_corners=False).to(dtype=dtype,
+                                                                                           device=device)
+        if photometric:
+            cached['offset'] = offset.to(dtype=dtype, device=device)
+            cached['noise_std'] = noise_variance.sqrt().to(dtype=dtype, device=device)
+
+        return cached
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -197,8 +460,12 @@ def main():
     transforms = torchvision.transforms.ToTensor()
     image = transforms(image)
 
-    transformation = get_transformation(args.transformation_type)
-    image = transformation(image.cuda())
+    transformation_types = args.transformation_type.split(',')
+    if len(transformation_types) > 1:
+        transformation = ComposedTransformation(transformation_types)
+    else:
+        transformation = get_transformation(args.transformation_type)
+    image = transformation(image.to(get_default_device()))
 
     plot(image)
 